@@ -0,0 +1,237 @@
+# this file is for picking the number of workers, envs per worker and rollout
+# fragment length that sample fastest on this machine, stored per host
+import os
+import json
+import time
+import socket
+from pathlib import Path
+from collections import defaultdict
+
+from subprocess_envs import with_subprocess_envs
+
+AUTOTUNE_DIR = Path(os.environ.get("AUTOTUNE_DIR", "~/.cache/rl_autotune")).expanduser()
+
+TUNED_KEYS = ["num_workers", "num_envs_per_worker", "rollout_fragment_length"]
+
+# a configuration within this fraction of the fastest one is preferred if it
+# samples more per GB of memory, or runs fewer simulators if that is unknown
+_TOLERANCE = 0.05
+
+
+def _host_file():
+    return AUTOTUNE_DIR / f"{socket.gethostname()}.json"
+
+
+def _load_host():
+    path = _host_file()
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        host = json.load(f)
+    # calibrated on different hardware, e.g. a resized VM
+    if host.get("num_cpus") != os.cpu_count():
+        return {}
+    return host
+
+
+def _save_host(host):
+    path = _host_file()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(host, f, indent=2, sort_keys=True)
+    tmp_path.replace(path)
+
+
+def load_tuned(name):
+    """The configuration stored for `name` on this host, or None."""
+    return _load_host().get("trainers", {}).get(name)
+
+
+def save_tuned(name, tuned):
+    host = _load_host()
+    host["num_cpus"] = os.cpu_count()
+    host.setdefault("trainers", {})[name] = tuned
+    _save_host(host)
+
+
+def _calibration_config(tune_config, num_workers, num_envs, fragment_length):
+    env_config = dict(tune_config["env_config"])
+    # tune.sample_from(..) is only resolved by tune.run
+    env_config["seed"] = 42
+    env_config["headless"] = True
+    # one fragment per env and a single cheap sgd pass, the round measures
+    # sampling
+    batch_size = num_workers * num_envs * fragment_length
+    config = dict(
+        tune_config,
+        env_config=env_config,
+        num_workers=num_workers,
+        num_envs_per_worker=num_envs,
+        rollout_fragment_length=fragment_length,
+        train_batch_size=batch_size,
+        sgd_minibatch_size=min(tune_config.get("sgd_minibatch_size", 128), batch_size),
+        num_sgd_iter=1,
+    )
+    # measured the way the trainers run them
+    return with_subprocess_envs(config)
+
+
+def _process_tree_memory_mb(pid=None):
+    # proportional set size of the process and all its descendants (env
+    # processes, SUMO), pages shared between processes are split between
+    # them, so the sum over all workers counts them once. Linux only, None
+    # elsewhere
+    root = pid or os.getpid()
+    children = defaultdict(list)
+    for stat in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # the command name in parentheses may contain spaces
+            ppid = int(stat.read_text().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children[ppid].append(int(stat.parent.name))
+
+    total_kb = 0
+    pids = [root]
+    while pids:
+        pid = pids.pop()
+        pids.extend(children[pid])
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                total_kb += sum(
+                    int(line.split()[1]) for line in f if line.startswith("Pss:")
+                )
+        except OSError:
+            # the process exited, or no smaps_rollup (not Linux, before 4.14)
+            if pid == root:
+                return None
+    return total_kb / 1024
+
+
+def _sampler_memory_mb(trainer):
+    # memory of the rollout workers with their envs, the driver and the
+    # learner are the same for every configuration
+    import ray
+
+    workers = trainer.workers.remote_workers()
+    if not workers:
+        return _process_tree_memory_mb()
+    memory = ray.get(
+        [worker.apply.remote(lambda _: _process_tree_memory_mb()) for worker in workers]
+    )
+    return None if None in memory else sum(memory)
+
+
+def measure(tune_config, num_workers, num_envs, fragment_length, iterations=2):
+    """Env steps per second of PPO with this configuration, over
+    `iterations` training iterations after a warm up one that starts the
+    simulators, and the memory of the rollout workers and their envs in MB
+    (None if it cannot be measured).
+    """
+    from ray.rllib.agents.ppo import PPOTrainer
+
+    config = _calibration_config(tune_config, num_workers, num_envs, fragment_length)
+    trainer = PPOTrainer(env=config.pop("env"), config=config)
+    try:
+        trainer.train()
+        steps = 0
+        start = time.perf_counter()
+        for _ in range(iterations):
+            steps += trainer.train()["timesteps_this_iter"]
+        samples_per_s = steps / (time.perf_counter() - start)
+        return samples_per_s, _sampler_memory_mb(trainer)
+    finally:
+        trainer.stop()
+
+
+def _powers_of_two(limit):
+    values = []
+    value = 1
+    while value <= limit:
+        values.append(value)
+        value *= 2
+    return values
+
+
+def calibrate(tune_config, num_cpus=None, fragment_lengths=(50, 100, 200, 400)):
+    """Measures worker and env counts with 200 step fragments, then the
+    fragment lengths for the fastest of them, and returns the best one.
+
+    Every env runs its own SUMO process next to the worker, so at most one
+    env per core is tried, keeping a core for the driver. The same number of
+    simulators is tried as more workers and as more envs per worker, whose
+    extra envs run in processes without tensorflow (see subprocess_envs.py),
+    and their memory per sample is reported.
+    """
+    num_cpus = num_cpus or os.cpu_count()
+    max_envs = max(num_cpus - 1, 1)
+    candidates = [
+        (num_workers, num_envs)
+        for num_workers in sorted(set(_powers_of_two(max_envs) + [max_envs]))
+        for num_envs in (1, 2, 4)
+        if num_workers * num_envs <= max_envs
+    ]
+
+    measured = []
+
+    def run(num_workers, num_envs, fragment_length):
+        samples_per_s, memory_mb = measure(
+            tune_config, num_workers, num_envs, fragment_length
+        )
+        result = dict(
+            zip(TUNED_KEYS, (num_workers, num_envs, fragment_length)),
+            samples_per_s=samples_per_s,
+            memory_mb=memory_mb,
+        )
+        message = (
+            f"autotune: {num_workers} workers, {num_envs} envs per worker, "
+            f"fragments of {fragment_length}: {samples_per_s:.1f} samples/s"
+        )
+        if memory_mb is not None:
+            result["samples_per_s_per_gb"] = samples_per_s / (memory_mb / 1024)
+            message += (
+                f", {memory_mb:.0f} MB, "
+                f"{result['samples_per_s_per_gb']:.1f} samples/s per GB"
+            )
+        print(message)
+        measured.append(result)
+        return result
+
+    def best(results):
+        fastest = max(result["samples_per_s"] for result in results)
+        good = [r for r in results if r["samples_per_s"] >= (1 - _TOLERANCE) * fastest]
+        if all("samples_per_s_per_gb" in r for r in good):
+            return max(good, key=lambda r: r["samples_per_s_per_gb"])
+        return min(good, key=lambda r: r["num_workers"] * r["num_envs_per_worker"])
+
+    chosen = best([run(*candidate, 200) for candidate in candidates])
+    chosen = best(
+        [chosen]
+        + [
+            run(chosen["num_workers"], chosen["num_envs_per_worker"], length)
+            for length in fragment_lengths
+            if length != chosen["rollout_fragment_length"]
+        ]
+    )
+    return dict(chosen, measured=measured)
+
+
+def autotuned_config(name, tune_config, force=False):
+    """The tuned keys of `tune_config` for trainer `name`, calibrated once
+    per host and read from AUTOTUNE_DIR afterwards, or again with `force`.
+    """
+    tuned = None if force else load_tuned(name)
+    if tuned is None:
+        import ray
+
+        ray.init(ignore_reinit_error=True)
+        tuned = calibrate(tune_config)
+        save_tuned(name, tuned)
+        print(f"autotune: saved to {_host_file()}")
+
+    print(
+        "autotune: {} workers, {} envs per worker, fragments of {} ({:.1f} "
+        "samples/s)".format(*[tuned[key] for key in TUNED_KEYS], tuned["samples_per_s"])
+    )
+    return {key: tuned[key] for key in TUNED_KEYS}
@@ -0,0 +1,205 @@
+# this file is for the RLlib episode callbacks, aggregating per step metrics of
+# all agents in constant memory and logging through a rate limited sink
+import sys
+import time
+import atexit
+from collections import deque
+
+# quantiles reported for every metric, the low ones matter for ttc
+QUANTILES = (0.1, 0.5, 0.9)
+
+# episode metric -> function of the raw observation of one agent, the dict
+# of the lane ttc observation adapters, whose ego_ttc is centred on the ego
+# lane
+STEP_METRICS = {
+    "ego_speed": lambda obs: obs["speed"][0],
+    "ego_ttc": lambda obs: obs["ego_ttc"][len(obs["ego_ttc"]) // 2],
+    "lateral_error": lambda obs: obs["distance_from_center"][0],
+}
+
+
+class P2Quantile:
+    """Running estimate of the `p` quantile with the P-square algorithm
+    (Jain and Chlamtac, 1985), five markers whatever the number of samples.
+    """
+
+    __slots__ = ("p", "q", "n", "desired", "increments")
+
+    def __init__(self, p):
+        self.p = p
+        self.q = []
+        self.n = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        q, n = self.q, self.n
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # move the middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qi = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not q[i - 1] < qi < q[i + 1]:
+                    qi = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qi
+                n[i] += d
+
+    def value(self):
+        if len(self.q) < 5:
+            # exact for the first samples
+            if not self.q:
+                return float("nan")
+            return self.q[min(int(self.p * len(self.q)), len(self.q) - 1)]
+        return self.q[2]
+
+
+class RunningStats:
+    """Count, mean, min, max and quantiles of a stream of numbers."""
+
+    __slots__ = ("count", "mean", "min", "max", "quantiles")
+
+    def __init__(self, quantiles=QUANTILES):
+        self.count = 0
+        self.mean = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+
+    def add(self, x):
+        x = float(x)
+        self.count += 1
+        self.mean += (x - self.mean) / self.count
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        for quantile in self.quantiles:
+            quantile.add(x)
+
+    def summary(self, name):
+        """Metrics named `<name>_mean`, `<name>_p50`, ..., empty without
+        samples.
+        """
+        if not self.count:
+            return {}
+        metrics = {
+            f"{name}_mean": self.mean,
+            f"{name}_min": self.min,
+            f"{name}_max": self.max,
+        }
+        for quantile in self.quantiles:
+            metrics[f"{name}_p{round(quantile.p * 100)}"] = quantile.value()
+        return metrics
+
+
+class RateLimitedLog:
+    """Buffers log lines and writes them in one go at most every
+    `interval` seconds, keeping the last `max_lines` and counting the
+    dropped ones.
+    """
+
+    def __init__(self, interval=10.0, max_lines=20, stream=None):
+        self.interval = interval
+        self.stream = stream
+        self._lines = deque(maxlen=max_lines)
+        self._dropped = 0
+        self._last_flush = time.monotonic()
+
+    def log(self, line):
+        if len(self._lines) == self._lines.maxlen:
+            self._dropped += 1
+        self._lines.append(line)
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._lines:
+            return
+        lines = list(self._lines)
+        if self._dropped:
+            lines.insert(0, f"... {self._dropped} lines dropped")
+        self._lines.clear()
+        self._dropped = 0
+        stream = self.stream or sys.stdout
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+
+
+# one per worker process
+log = RateLimitedLog()
+atexit.register(log.flush)
+
+
+def on_episode_start(info):
+    episode = info["episode"]
+    episode.user_data["stats"] = {name: RunningStats() for name in STEP_METRICS}
+    episode.user_data["last_obs"] = {}
+
+
+def on_episode_step(info):
+    episode = info["episode"]
+    stats = episode.user_data["stats"]
+    last_obs = episode.user_data["last_obs"]
+    for agent_id, obs in episode._agent_to_last_raw_obs.items():
+        # agents that are done keep their last observation, count it once.
+        # The training adapters return a new dict every step
+        if obs is None or last_obs.get(agent_id) is obs:
+            continue
+        last_obs[agent_id] = obs
+        for name, metric in STEP_METRICS.items():
+            stats[name].add(metric(obs))
+
+
+def on_episode_end(info):
+    episode = info["episode"]
+    for name, stats in episode.user_data["stats"].items():
+        episode.custom_metrics.update(stats.summary(name))
+
+    # kept for the dashboards that plot them
+    speed = episode.user_data["stats"]["ego_speed"]
+    if speed.count:
+        episode.custom_metrics["mean_ego_speed"] = speed.mean
+
+    agent_scores = [info["score"] for info in episode._agent_to_last_info.values()]
+    mean_dis = sum(agent_scores) / max(len(agent_scores), 1)
+    episode.custom_metrics["distance_travelled"] = mean_dis
+
+    log.log(
+        "episode {} ended with length {}, distance {}, and mean ego speed {:.2f}".format(
+            episode.episode_id, episode.length, mean_dis, speed.mean
+        )
+    )
+
+
+def episode_callbacks():
+    """The RLlib callbacks of the trainers, other ones can be added."""
+    return {
+        "on_episode_start": on_episode_start,
+        "on_episode_step": on_episode_step,
+        "on_episode_end": on_episode_end,
+    }
@@ -0,0 +1,168 @@
+# this file is for recording episodes to disk and reading them back
+import json
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+# one row per step in every file, obs and action are flattened to float32
+SCHEMA = {
+    "obs": np.float32,
+    "action": np.float32,
+    "reward": np.float32,
+    "done": np.uint8,
+}
+
+META_FILE = "meta.json"
+
+
+def new_episode_id():
+    return uuid.uuid4().hex
+
+
+def _flatten(value):
+    # dict observations are flattened in sorted key order, the same order as
+    # RLlib's dict preprocessor
+    if isinstance(value, dict):
+        return np.concatenate([_flatten(value[key]) for key in sorted(value)])
+    return np.ravel(np.asarray(value, dtype=np.float32))
+
+
+class EpisodeWriter:
+    """Appends the steps of one agent's episode to one raw file per field of
+    SCHEMA under `path`. The files only ever grow, so a writer can be
+    reopened to append more steps, and readers can memory-map them while
+    they are being written.
+    """
+
+    def __init__(self, path, obs_dim, action_dim, meta=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._dims = {"obs": obs_dim, "action": action_dim, "reward": 1, "done": 1}
+
+        meta_path = self.path / META_FILE
+        if not meta_path.exists():
+            meta = dict(meta or {})
+            meta["dims"] = self._dims
+            meta["dtypes"] = {name: np.dtype(t).str for name, t in SCHEMA.items()}
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+
+        self._files = {name: open(self.path / name, "ab") for name in SCHEMA}
+
+    def append(self, obs, action, reward, done):
+        self.extend([obs], [action], [reward], [done])
+
+    def extend(self, obs, actions, rewards, dones):
+        # writes one row per step, all arguments have the same length
+        columns = {"obs": obs, "action": actions, "reward": rewards, "done": dones}
+        for name, values in columns.items():
+            rows = np.asarray(values, dtype=SCHEMA[name])
+            rows = rows.reshape(len(rows), self._dims[name])
+            self._files[name].write(rows.tobytes())
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EpisodeRecorder:
+    """Records the steps of every agent of every running episode to
+    `record_dir/<episode_id>/<agent_id>/`, call `end_episode(..)` once an
+    episode is done to close its files.
+    """
+
+    def __init__(self, record_dir):
+        self._record_dir = Path(record_dir)
+        self._writers = {}
+
+    def record_step(self, episode_id, agent_id, obs, action, reward, done):
+        obs = _flatten(obs)
+        action = _flatten(action)
+
+        key = (episode_id, agent_id)
+        writer = self._writers.get(key)
+        if writer is None:
+            writer = EpisodeWriter(
+                self._record_dir / str(episode_id) / str(agent_id),
+                obs_dim=len(obs),
+                action_dim=len(action),
+                meta={"episode_id": str(episode_id), "agent_id": str(agent_id)},
+            )
+            self._writers[key] = writer
+
+        writer.append(obs, action, reward, done)
+
+    def end_episode(self, episode_id):
+        for key in [key for key in self._writers if key[0] == episode_id]:
+            self._writers.pop(key).close()
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+
+def postprocess_traj_recorder(record_dir):
+    """Returns an RLlib `on_postprocess_traj` callback that appends every
+    postprocessed trajectory to `record_dir/<episode_id>/<agent_id>/`. The
+    observations are the ones the policy saw, already flattened by the
+    preprocessor.
+    """
+
+    def on_postprocess_traj(info):
+        episode = info["episode"]
+        agent_id = info["agent_id"]
+        batch = info["post_batch"]
+
+        obs = batch["obs"].reshape(batch.count, -1)
+        actions = batch["actions"].reshape(batch.count, -1)
+        with EpisodeWriter(
+            Path(record_dir) / str(episode.episode_id) / str(agent_id),
+            obs_dim=obs.shape[1],
+            action_dim=actions.shape[1],
+            meta={"episode_id": str(episode.episode_id), "agent_id": str(agent_id)},
+        ) as writer:
+            writer.extend(obs, actions, batch["rewards"], batch["dones"])
+
+    return on_postprocess_traj
+
+
+def list_episodes(record_dir):
+    """Returns the directories of all recorded agent episodes under
+    `record_dir`, in a stable order.
+    """
+    return sorted(path.parent for path in Path(record_dir).glob(f"*/*/{META_FILE}"))
+
+
+def read_episode(path):
+    """Returns {field: array of shape (steps, dim)} of an agent episode
+    written by EpisodeWriter, memory-mapped read-only so the episode is not
+    loaded into memory.
+    """
+    path = Path(path)
+    with open(path / META_FILE) as f:
+        meta = json.load(f)
+
+    arrays = {}
+    for name, dtype in meta["dtypes"].items():
+        dtype = np.dtype(dtype)
+        dim = meta["dims"][name]
+        # only whole rows, a writer may be appending concurrently
+        steps = (path / name).stat().st_size // (dtype.itemsize * dim)
+        if steps == 0:
+            arrays[name] = np.empty((0, dim), dtype=dtype)
+        else:
+            arrays[name] = np.memmap(
+                path / name, dtype=dtype, mode="r", shape=(steps, dim)
+            )
+
+    # a writer may be in between fields, only keep steps that every field has
+    steps = min(len(values) for values in arrays.values())
+    return {name: values[:steps] for name, values in arrays.items()}
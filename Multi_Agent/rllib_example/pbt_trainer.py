@@ -2,14 +2,14 @@ import os
 import random
 import argparse
 
-import numpy as np
 from ray import tune
 from ray.tune.schedulers import PopulationBasedTraining
 
 import smarts
-from smarts.env.rllib_hiway_env import RLlibHiWayEnv
 from smarts.core.utils import copy_tree
 
+import episode_metrics
+from throughput_metrics import TimedHiWayEnv, throughput_callbacks
 from agent import agent, TrainingModel
 
 
@@ -19,38 +19,6 @@ scenario_path = os.path.join(
 )
 
 
-def on_episode_start(info):
-    episode = info["episode"]
-    print("episode {} started".format(episode.episode_id))
-    episode.user_data["ego_speed"] = []
-
-
-def on_episode_step(info):
-    episode = info["episode"]
-    single_agent_id = list(episode._agent_to_last_obs)[0]
-    obs = episode.last_raw_obs_for(single_agent_id)
-    episode.user_data["ego_speed"].append(obs["speed"])
-
-
-def on_episode_end(info):
-    episode = info["episode"]
-    mean_ego_speed = np.mean(episode.user_data["ego_speed"])
-
-    episode.custom_metrics["mean_ego_speed"] = mean_ego_speed
-
-    agent_scores = []
-    for info in episode._agent_to_last_info.values():
-        agent_scores.append(info["score"])
-    mean_dis = np.mean(agent_scores)
-    episode.custom_metrics["distance_travelled"] = mean_dis
-
-    print(
-        "episode {} ended with length {}, distance {}, and mean ego speed {:.2f}".format(
-            episode.episode_id, episode.length, mean_dis, mean_ego_speed
-        )
-    )
-
-
 def explore(config):
     # ensure we collect enough timesteps to do sgd
     if config["train_batch_size"] < config["sgd_minibatch_size"] * 2:
@@ -94,7 +62,7 @@ def main(args):
 
     smarts.core.seed(args.seed)
     tune_config = {
-        "env": RLlibHiWayEnv,
+        "env": TimedHiWayEnv,
         "log_level": "WARN",
         "num_workers": args.num_workers,
         "env_config": {
@@ -104,11 +72,7 @@ def main(args):
             "agents": {f"AGENT-{i}": agent for i in range(args.num_agents)},
         },
         "multiagent": {"policies": rllib_policies},
-        "callbacks": {
-            "on_episode_start": on_episode_start,
-            "on_episode_step": on_episode_step,
-            "on_episode_end": on_episode_end,
-        },
+        "callbacks": throughput_callbacks(episode_metrics.episode_callbacks()),
     }
 
     experiment_name = "rllib_pbt_example"
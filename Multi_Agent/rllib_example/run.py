@@ -1,7 +1,7 @@
 from pathlib import Path
 
 import ray
-from agent import agent
+from agent import flat_agent as agent, flat_observation_adapter
 
 from smarts.env.rllib_hiway_env import RLlibHiWayEnv
 
@@ -25,6 +25,7 @@ def main():
     )
 
     agent.reset()
+    flat_observation_adapter.reset()
     observations = env.reset()
 
     total_reward = 0.0
@@ -0,0 +1,200 @@
+# this file is for running the extra envs of a rollout worker in simulator-only
+# processes, acted for with one batched policy call
+import traceback
+import multiprocessing
+from collections import deque
+
+from ray.rllib.env.base_env import BaseEnv, ASYNC_RESET_RETURN
+
+from throughput_metrics import TimedHiWayEnv
+
+
+def _episode_metrics(env, result):
+    # the metrics of the episode a step ended, see TimedHiWayEnv
+    _, _, dones, _ = result
+    if dones["__all__"] and hasattr(env, "episode_metrics"):
+        return env.episode_metrics()
+    return None
+
+
+def _env_process(conn, env_class, config):
+    # hosts one env, without the policy, tensorflow or the ray worker
+    env = env_class(config)
+    before_reset = config.get("before_reset")
+    try:
+        while True:
+            command, data = conn.recv()
+            if command == "close":
+                break
+            try:
+                if command == "reset":
+                    if before_reset is not None:
+                        before_reset()
+                    conn.send((True, env.reset(), None))
+                else:
+                    result = env.step(data)
+                    conn.send((True, result, _episode_metrics(env, result)))
+            except Exception:
+                conn.send((False, traceback.format_exc(), None))
+    finally:
+        env.close()
+        conn.close()
+
+
+def _reset_result(observations):
+    # what RLlib expects from the first poll of an episode
+    return (
+        observations,
+        {agent_id: 0 for agent_id in observations},
+        {"__all__": False},
+        {agent_id: {} for agent_id in observations},
+    )
+
+
+class SubprocessHiWayEnv(BaseEnv):
+    """`config["num_envs"]` envs of `config["env_class"]` for one rollout
+    worker. The first one runs in the worker, the others each in their own
+    process: SMARTS is a panda3d ShowBase, which allows one per process, so
+    the simulators cannot share one. Like extra rollout workers every env
+    process runs a simulator and its SUMO, but it holds no tensorflow, policy
+    or ray worker, and the worker acts for all envs with one batched policy
+    call. `autotune.py` measures the memory per sample of both.
+
+    `config["before_reset"]`, if given, is called before every reset in
+    the process of the env, e.g. to reset the state of the adapters there.
+
+    Every step is sent to all envs before the one in the worker runs, so
+    the simulators step concurrently. Resets are asynchronous and overlap
+    with the steps of the other envs. The metrics of TimedHiWayEnv are sent
+    back with the last step of every episode, see `pop_episode_metrics()`.
+    """
+
+    def __init__(self, config):
+        self._num_envs = config.get("num_envs", 1)
+        self._before_reset = config.get("before_reset")
+        env_class = config.get("env_class", TimedHiWayEnv)
+
+        # spawn, forking a worker that already holds a tf session is unsafe
+        ctx = multiprocessing.get_context("spawn")
+        self._conns = {}
+        self._procs = []
+        for env_id in range(1, self._num_envs):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(
+                target=_env_process,
+                args=(
+                    child_conn,
+                    env_class,
+                    config.copy_with_overrides(vector_index=env_id),
+                ),
+                daemon=True,
+            )
+            proc.start()
+            child_conn.close()
+            self._conns[env_id] = parent_conn
+            self._procs.append(proc)
+        self._local_env = env_class(config)
+
+        self._local_request = None
+        self._pending = {}
+        self._dones = set()
+        self._episode_metrics = deque()
+        self._started = False
+
+    def _request(self, env_id, command, data=None):
+        if env_id == 0:
+            # runs in poll(), while the other envs work
+            self._local_request = (command, data)
+        else:
+            self._conns[env_id].send((command, data))
+            self._pending[env_id] = command
+
+    def _local_result(self):
+        command, data = self._local_request
+        self._local_request = None
+        if command == "reset":
+            if self._before_reset is not None:
+                self._before_reset()
+            return _reset_result(self._local_env.reset())
+
+        result = self._local_env.step(data)
+        metrics = _episode_metrics(self._local_env, result)
+        if metrics is not None:
+            self._episode_metrics.append(metrics)
+        return result
+
+    def _remote_result(self, env_id):
+        command = self._pending.pop(env_id)
+        ok, result, metrics = self._conns[env_id].recv()
+        if not ok:
+            raise RuntimeError(f"env {env_id} failed to {command}:\n{result}")
+        if metrics is not None:
+            self._episode_metrics.append(metrics)
+        return _reset_result(result) if command == "reset" else result
+
+    def poll(self):
+        if not self._started:
+            self._started = True
+            for env_id in range(self._num_envs):
+                self._request(env_id, "reset")
+
+        results = {}
+        if self._local_request is not None:
+            results[0] = self._local_result()
+        for env_id in list(self._pending):
+            results[env_id] = self._remote_result(env_id)
+
+        observations, rewards, dones, infos = {}, {}, {}, {}
+        for env_id, result in results.items():
+            observations[env_id], rewards[env_id], dones[env_id], infos[env_id] = result
+            if dones[env_id]["__all__"]:
+                self._dones.add(env_id)
+        return observations, rewards, dones, infos, {}
+
+    def send_actions(self, action_dict):
+        for env_id, actions in action_dict.items():
+            if env_id in self._dones:
+                raise ValueError(f"env {env_id} is done and needs a reset")
+            self._request(env_id, "step", actions)
+
+    def try_reset(self, env_id):
+        self._dones.discard(env_id)
+        self._request(env_id, "reset")
+        return ASYNC_RESET_RETURN
+
+    def pop_episode_metrics(self):
+        """The metrics of the oldest episode that ended in any of the envs and
+        was not popped yet, {} if there is none. The sampler calls
+        `on_episode_end` once per episode, right after the poll ending it.
+        """
+        return self._episode_metrics.popleft() if self._episode_metrics else {}
+
+    def get_unwrapped(self):
+        # the envs in other processes are not reachable
+        return [self._local_env]
+
+    def stop(self):
+        for conn in self._conns.values():
+            conn.send(("close", None))
+        for proc in self._procs:
+            proc.join()
+        self._local_env.close()
+
+
+def with_subprocess_envs(tune_config):
+    """`tune_config` with its `num_envs_per_worker` envs hosted by one
+    SubprocessHiWayEnv per worker instead of stepped one after the other in
+    the worker, which SMARTS does not allow.
+    """
+    num_envs = tune_config.get("num_envs_per_worker", 1)
+    if num_envs <= 1:
+        return tune_config
+    env_config = dict(
+        tune_config["env_config"], num_envs=num_envs, env_class=tune_config["env"]
+    )
+    return dict(
+        tune_config,
+        env=SubprocessHiWayEnv,
+        env_config=env_config,
+        num_envs_per_worker=1,
+    )
@@ -5,11 +5,10 @@ from pathlib import Path
 
 import gym
 import numpy as np
-from custom_observations import lane_ttc_observation_adapter
-from ray.rllib.models import ModelCatalog
-from ray.rllib.models.tf.fcnet_v2 import FullyConnectedNetwork
-from ray.rllib.utils import try_import_tf
-
+from custom_observations import (
+    incremental_lane_ttc_observation_adapter,
+    preallocated_lane_ttc_observation_adapter,
+)
 from smarts.core.agent_interface import (
     AgentInterface,
     AgentType,
@@ -17,7 +16,10 @@ from smarts.core.agent_interface import (
 from smarts.core.controllers import ActionSpaceType
 from smarts.env.agent import Agent, AgentPolicy
 
-tf = try_import_tf()
+# ray and tensorflow are only imported once a policy is set up or the
+# training model is registered. The smarts imports above still load pybullet,
+# panda3d and scipy through agent_interface -> controllers -> vehicle; they
+# stay, since the evaluation imports the agents below, which need them.
 
 #########################################
 # Spaces and Adpaters
@@ -32,12 +34,42 @@ ACTION_SPACE = gym.spaces.Box(
 # discrete action space
 # ACTION_SPACE = gym.spaces.Discrete(4)
 
+# Number of lanes around the ego lane in the ttc and lane distance
+# observations, odd so the ego lane is the centre. Changing it changes the
+# observation spaces below, so models have to be retrained.
+EGO_LANE_WINDOW = 5
+
+# The adapters reuse the waypoint geometry of the previous step. The flat one
+# is only used for evaluation, where the policy consumes the observation right
+# away, so it also reuses its output buffers instead of allocating new arrays.
+_observation_adapter = incremental_lane_ttc_observation_adapter(
+    ego_lane_window=EGO_LANE_WINDOW
+)
+_flat_observation_adapter = preallocated_lane_ttc_observation_adapter(
+    flat=True, ego_lane_window=EGO_LANE_WINDOW
+)
+
 # This observation space should match the output of observation_adapter(..) below
-OBSERVATION_SPACE = lane_ttc_observation_adapter.space
+OBSERVATION_SPACE = _observation_adapter.space
+
+# The same observation already flattened to the model input, in the order
+# RLlib's preprocessor flattens OBSERVATION_SPACE. Policies skip the
+# preprocessor for it.
+FLAT_OBSERVATION_SPACE = _flat_observation_adapter.space
 
 
 def observation_adapter(env_observation):
-    return lane_ttc_observation_adapter.transform(env_observation)
+    return _observation_adapter.transform(env_observation)
+
+
+def flat_observation_adapter(env_observation):
+    return _flat_observation_adapter.transform(env_observation)
+
+
+def reset_observation_adapters():
+    # call before env.reset(), the next episode may run on another map
+    _observation_adapter.transform.reset()
+    _flat_observation_adapter.transform.reset()
 
 
 def reward_adapter(env_obs, env_reward):
@@ -60,11 +92,34 @@ def action_adapter(model_action):
 """
 
 
-class TrainingModel(FullyConnectedNetwork):
-    NAME = "FullyConnectedNetwork"
+TRAINING_MODEL_NAME = "FullyConnectedNetwork"
+
+
+def register_training_model():
+    from ray.rllib.models import ModelCatalog
+    from ray.rllib.models.tf.fcnet_v2 import FullyConnectedNetwork
+
+    class TrainingModel(FullyConnectedNetwork):
+        NAME = TRAINING_MODEL_NAME
+
+    ModelCatalog.register_custom_model(TrainingModel.NAME, TrainingModel)
+    return TrainingModel
+
+
+def _import_tf():
+    from ray.rllib.utils import try_import_tf
+
+    return try_import_tf()
+
+
+def _preprocessor_for_space(observation_space):
+    # flat observations are already the model input
+    if isinstance(observation_space, gym.spaces.Box):
+        return None
 
+    from ray.rllib.models import ModelCatalog
 
-ModelCatalog.register_custom_model(TrainingModel.NAME, TrainingModel)
+    return ModelCatalog.get_preprocessor_for_space(observation_space)
 
 
 #########################################
@@ -92,6 +147,7 @@ class RLlibTFCheckpointPolicy(AgentPolicy):
         if self._sess:
             return
 
+        tf = _import_tf()
         if self._algorithm == "PPO":
             from ray.rllib.agents.ppo.ppo_tf_policy import PPOTFPolicy as LoadPolicy
         elif self._algorithm in ["A2C", "A3C"]:
@@ -103,13 +159,16 @@ class RLlibTFCheckpointPolicy(AgentPolicy):
         else:
             raise TypeError("Unsupport algorithm")
 
-        self._prep = ModelCatalog.get_preprocessor_for_space(self._observation_space)
+        self._prep = _preprocessor_for_space(self._observation_space)
         self._sess = tf.Session(graph=tf.Graph())
         self._sess.__enter__()
 
         with tf.name_scope(self._policy_name):
             # obs_space need to be flattened before passed to PPOTFPolicy
-            flat_obs_space = self._prep.observation_space
+            if self._prep is not None:
+                flat_obs_space = self._prep.observation_space
+            else:
+                flat_obs_space = self._observation_space
             self.policy = LoadPolicy(flat_obs_space, self._action_space, {})
             objs = pickle.load(open(self._load_path, "rb"))
             objs = pickle.loads(objs["worker"])
@@ -122,19 +181,36 @@ class RLlibTFCheckpointPolicy(AgentPolicy):
         pass
 
     def act(self, obs):
-        obs = self._prep.transform(obs)
+        if self._sess is None:
+            self.setup()
+        if self._prep is not None:
+            obs = self._prep.transform(obs)
         action = self.policy.compute_actions([obs], explore=False)[0][0]
 
         return action
 
+    def act_batch(self, obs_dict):
+        # one forward pass for the observations of all agents sharing this policy
+        if self._sess is None:
+            self.setup()
+        agent_ids = list(obs_dict)
+        obs_batch = [obs_dict[agent_id] for agent_id in agent_ids]
+        if self._prep is not None:
+            obs_batch = [self._prep.transform(obs) for obs in obs_batch]
+        actions = self.policy.compute_actions(obs_batch, explore=False)[0]
+
+        return dict(zip(agent_ids, actions))
+
 
 #########################################
 # restore checkpoint exported at end, like checkpoint/checkpoint
 #########################################
 class RLlibFinalCkptPolicy(AgentPolicy):
     def __init__(self, path_to_model, observation_space, action_space):
-        self._prep = ModelCatalog.get_preprocessor_for_space(observation_space)
+        self._observation_space = observation_space
         self._path_to_model = path_to_model
+        self._prep = None
+        self._sess = None
 
         if isinstance(action_space, gym.spaces.Box):
             self.is_continuous = True
@@ -144,6 +220,8 @@ class RLlibFinalCkptPolicy(AgentPolicy):
             raise TypeError("Unsupport action space")
 
     def setup(self):
+        tf = _import_tf()
+        self._prep = _preprocessor_for_space(self._observation_space)
         self._sess = tf.Session(graph=tf.Graph())
         self._sess.__enter__()
         saver = tf.train.import_meta_graph(
@@ -172,19 +250,35 @@ class RLlibFinalCkptPolicy(AgentPolicy):
         pass
 
     def act(self, obs):
-        obs = self._prep.transform(obs)
+        if self._sess is None:
+            self.setup()
+        if self._prep is not None:
+            obs = self._prep.transform(obs)
         res = self._sess.run(self.output_node, feed_dict={self.input_node: [obs]})
         action = res[0]
         return action
 
+    def act_batch(self, obs_dict):
+        # one forward pass for the observations of all agents sharing this policy
+        if self._sess is None:
+            self.setup()
+        agent_ids = list(obs_dict)
+        obs_batch = [obs_dict[agent_id] for agent_id in agent_ids]
+        if self._prep is not None:
+            obs_batch = [self._prep.transform(obs) for obs in obs_batch]
+        res = self._sess.run(self.output_node, feed_dict={self.input_node: obs_batch})
+        return dict(zip(agent_ids, res))
+
 
 #########################################
 # restore model exported at end, like model/
 #########################################
 class RLlibModelPolicy(AgentPolicy):
     def __init__(self, path_to_model, observation_space, action_space):
-        self._prep = ModelCatalog.get_preprocessor_for_space(observation_space)
+        self._observation_space = observation_space
         self._path_to_model = path_to_model
+        self._prep = None
+        self._sess = None
 
         if isinstance(action_space, gym.spaces.Box):
             self.is_continuous = True
@@ -194,6 +288,8 @@ class RLlibModelPolicy(AgentPolicy):
             raise TypeError("Unsupport action space")
 
     def setup(self):
+        tf = _import_tf()
+        self._prep = _preprocessor_for_space(self._observation_space)
         self._sess = tf.Session(graph=tf.Graph())
         self._sess.__enter__()
         tf.saved_model.load(self._sess, export_dir=self._path_to_model, tags=["serve"])
@@ -217,13 +313,30 @@ class RLlibModelPolicy(AgentPolicy):
         pass
 
     def act(self, obs):
-        obs = self._prep.transform(obs)
+        if self._sess is None:
+            self.setup()
+        if self._prep is not None:
+            obs = self._prep.transform(obs)
         res = self._sess.run(self.output_node, feed_dict={self.input_node: [obs]})
         action = res[0]
         return action
 
+    def act_batch(self, obs_dict):
+        # one forward pass for the observations of all agents sharing this policy
+        if self._sess is None:
+            self.setup()
+        agent_ids = list(obs_dict)
+        obs_batch = [obs_dict[agent_id] for agent_id in agent_ids]
+        if self._prep is not None:
+            obs_batch = [self._prep.transform(obs) for obs in obs_batch]
+        res = self._sess.run(self.output_node, feed_dict={self.input_node: obs_batch})
+        return dict(zip(agent_ids, res))
+
 
 model_path = Path(__file__).parent / "model"
+# weights exported by export_numpy_model.py, for NumpyMLPPolicy (import it
+# from numpy_policy to use it below)
+numpy_model_path = Path(__file__).parent / "model.npz"
 # model_path = Path(__file__).parent / "checkpoint_200/checkpoint-200"
 # model_path = Path(__file__).parent / "checkpoint/checkpoint"
 
@@ -253,6 +366,7 @@ agent = Agent(
     ),
     # policy=RLlibTFCheckpointPolicy(str(model_path.absolute()), "PPO",   "default_policy", OBSERVATION_SPACE, ACTION_SPACE),
     # policy=RLlibFinalCkptPolicy(str(model_path.absolute()), OBSERVATION_SPACE, ACTION_SPACE),
+    # policy=NumpyMLPPolicy(str(numpy_model_path.absolute()), OBSERVATION_SPACE, ACTION_SPACE),
     observation_space=OBSERVATION_SPACE,
     action_space=ACTION_SPACE,
     observation_adapter=observation_adapter,
@@ -260,6 +374,25 @@ agent = Agent(
     action_adapter=action_adapter,
 )
 
+#########################################
+# continous action space agent for evaluation
+#########################################
+# same policy as above, but the observation adapter writes the flat model
+# input directly, so acting skips the RLlib preprocessor
+flat_agent = Agent(
+    interface=AgentInterface.from_type(
+        AgentType.StandardWithAbsoluteSteering, max_episode_steps=2000
+    ),
+    policy=RLlibModelPolicy(
+        str(model_path.absolute()), FLAT_OBSERVATION_SPACE, ACTION_SPACE
+    ),
+    observation_space=FLAT_OBSERVATION_SPACE,
+    action_space=ACTION_SPACE,
+    observation_adapter=flat_observation_adapter,
+    reward_adapter=reward_adapter,
+    action_adapter=action_adapter,
+)
+
 #########################################
 # discrete action space agent
 #########################################
@@ -0,0 +1,226 @@
+# this file is for measuring evaluation throughput with fixed seeds
+import json
+import time
+import argparse
+import platform
+import dataclasses
+from pathlib import Path
+from collections import defaultdict
+
+import gym
+import numpy as np
+
+from agent import agent, flat_agent, reset_observation_adapters
+
+
+scenario_dir = (Path(__file__).parent / "f1_public").resolve()
+scenario_names = ["shanghai", "silverstone", "monte", "interlagos"]
+
+AGENT_ID = "Agent-007"
+
+STAGES = [
+    "env_step",
+    "observation_adapter",
+    "preprocessor",
+    "policy_inference",
+    "action_adapter",
+]
+
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+
+        return timed
+
+
+def _timed_agent(base_agent, timer):
+    # the env calls the adapters inside env.step(..), so their time is
+    # subtracted from the env step time below
+    policy = base_agent.policy
+    policy.setup()
+    if policy._prep is not None:
+        policy._prep.transform = timer.wrap("preprocessor", policy._prep.transform)
+
+    return dataclasses.replace(
+        base_agent,
+        observation_adapter=timer.wrap(
+            "observation_adapter", base_agent.observation_adapter
+        ),
+        action_adapter=timer.wrap("action_adapter", base_agent.action_adapter),
+    )
+
+
+def run_scenario(scenario_path, timed_agent, timer, args):
+    env = gym.make(
+        "smarts.env:hiway-v0",
+        scenarios=[scenario_path],
+        agents={AGENT_ID: timed_agent},
+        headless=True,
+        visdom=False,
+        seed=args.seed,
+    )
+
+    steps = 0
+    episode_rewards = []
+    start = time.perf_counter()
+    for _ in range(args.episodes):
+        reset_observation_adapters()
+        adapter_before = timer.seconds["observation_adapter"]
+        reset_start = time.perf_counter()
+        observations = env.reset()
+        # the first observations are adapted in env.reset(), keep them out of
+        # the per step stages
+        timer.seconds["reset"] += time.perf_counter() - reset_start
+        timer.seconds["observation_adapter"] = adapter_before
+        total_reward = 0.0
+        dones = {"__all__": False}
+        episode_steps = 0
+
+        while not dones["__all__"] and episode_steps != args.max_episode_steps:
+            adapters_before = (
+                timer.seconds["observation_adapter"] + timer.seconds["action_adapter"]
+            )
+
+            act_start = time.perf_counter()
+            agent_action = timed_agent.act(observations[AGENT_ID])
+            step_start = time.perf_counter()
+            observations, rewards, dones, _ = env.step({AGENT_ID: agent_action})
+            step_end = time.perf_counter()
+
+            adapters = (
+                timer.seconds["observation_adapter"]
+                + timer.seconds["action_adapter"]
+                - adapters_before
+            )
+            timer.seconds["policy"] += step_start - act_start
+            timer.seconds["env_step"] += step_end - step_start - adapters
+
+            total_reward += rewards[AGENT_ID]
+            episode_steps += 1
+
+        steps += episode_steps
+        episode_rewards.append(total_reward)
+
+    wall_time = time.perf_counter() - start
+    env.close()
+
+    return {
+        "episodes": args.episodes,
+        "steps": steps,
+        "wall_time_s": wall_time,
+        "steps_per_s": steps / wall_time,
+        "episodes_per_s": args.episodes / wall_time,
+        "mean_reward": float(np.mean(episode_rewards)),
+    }
+
+
+def main(args):
+    base_agent = flat_agent if args.flat_observation else agent
+    results = {
+        "config": {
+            "scenarios": args.scenarios,
+            "episodes": args.episodes,
+            "max_episode_steps": args.max_episode_steps,
+            "seed": args.seed,
+            "flat_observation": args.flat_observation,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "scenarios": {},
+    }
+
+    total_steps = 0
+    total_episodes = 0
+    total_wall_time = 0.0
+    all_seconds = defaultdict(float)
+    timer = StageTimer()
+    timed_agent = _timed_agent(base_agent, timer)
+    for name in args.scenarios:
+        timer.seconds.clear()
+        result = run_scenario(scenario_dir / name, timed_agent, timer, args)
+
+        # policy time includes the preprocessor, split it off. Episodes that
+        # end on reset never act
+        timer.seconds["policy_inference"] = (
+            timer.seconds.pop("policy", 0.0) - timer.seconds["preprocessor"]
+        )
+        result["time_per_step_ms"] = {
+            stage: 1000 * timer.seconds[stage] / max(result["steps"], 1)
+            for stage in STAGES
+        }
+        result["reset_time_per_episode_ms"] = (
+            1000 * timer.seconds["reset"] / result["episodes"]
+        )
+        results["scenarios"][name] = result
+
+        total_steps += result["steps"]
+        total_episodes += result["episodes"]
+        total_wall_time += result["wall_time_s"]
+        for stage in STAGES + ["reset"]:
+            all_seconds[stage] += timer.seconds[stage]
+
+        print(
+            f"{name}: {result['steps_per_s']:.1f} steps/s, "
+            f"{result['episodes_per_s']:.3f} episodes/s"
+        )
+
+    results["total"] = {
+        "episodes": total_episodes,
+        "steps": total_steps,
+        "wall_time_s": total_wall_time,
+        "steps_per_s": total_steps / total_wall_time,
+        "episodes_per_s": total_episodes / total_wall_time,
+        "time_per_step_ms": {
+            stage: 1000 * all_seconds[stage] / max(total_steps, 1) for stage in STAGES
+        },
+        "reset_time_per_episode_ms": 1000 * all_seconds["reset"] / total_episodes,
+    }
+
+    print(f"\n{'stage':<20} {'ms/step':>10}")
+    for stage, ms in results["total"]["time_per_step_ms"].items():
+        print(f"{stage:<20} {ms:>10.3f}")
+    reset_ms = results["total"]["reset_time_per_episode_ms"]
+    print(f"{'reset (ms/episode)':<20} {reset_ms:>10.3f}")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote results to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark")
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        default=scenario_names,
+        help="Scenarios under f1_public to run",
+    )
+    parser.add_argument(
+        "--episodes", type=int, default=2, help="Number of episodes per scenario"
+    )
+    parser.add_argument(
+        "--max_episode_steps",
+        type=int,
+        default=None,
+        help="Cut episodes after this many steps",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Seed of every env")
+    parser.add_argument(
+        "--flat_observation",
+        action="store_true",
+        help="Benchmark the flat observation agent, which skips the preprocessor",
+    )
+    parser.add_argument(
+        "--output", type=str, default="benchmark.json", help="Path of the JSON results"
+    )
+    args = parser.parse_args()
+    main(args)
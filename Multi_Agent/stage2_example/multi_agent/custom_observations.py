@@ -1,37 +1,84 @@
 # this file is for custom observations
-import math
+import inspect
+import functools
+import contextlib
+import tracemalloc
 
 import numpy as np
 import gym
 
-from smarts.core.vehicle import Vehicle
 from smarts.core.utils.math import vec_2d
 from smarts.env.agent import Adapter
 
-_LANE_TTC_OBSERVATION_SPACE = gym.spaces.Dict(
-    {
-        "distance_from_center": gym.spaces.Box(low=-1e10, high=1e10, shape=(1,)),
-        "angle_error": gym.spaces.Box(low=-180, high=180, shape=(1,)),
-        "speed": gym.spaces.Box(low=-1e10, high=1e10, shape=(1,)),
-        "steering": gym.spaces.Box(low=-1e10, high=1e10, shape=(1,)),
-        "ego_lane_dist": gym.spaces.Box(low=-1e10, high=1e10, shape=(5,)),
-        "ego_ttc": gym.spaces.Box(low=-1e10, high=1e10, shape=(5,)),
-    }
-)
-
-
-def _lane_ttc_observation_adapter(env_observation):
+# lanes with at least this many waypoints are searched with a KD-tree instead
+# of comparing against every waypoint on the lane
+_KD_TREE_MIN_LANE_WAYPOINTS = 128
+
+# lanes in the ego_ttc and ego_lane_dist observations, the ego lane is the
+# centre, so the window has to be odd
+EGO_LANE_WINDOW = 5
+
+
+def _lane_ttc_observation_space(ego_lane_window=EGO_LANE_WINDOW):
+    if ego_lane_window % 2 != 1:
+        raise ValueError(f"ego_lane_window must be odd, got {ego_lane_window}")
+
+    return gym.spaces.Dict(
+        {
+            "distance_from_center": gym.spaces.Box(low=-1e10, high=1e10, shape=(1,)),
+            "angle_error": gym.spaces.Box(low=-180, high=180, shape=(1,)),
+            "speed": gym.spaces.Box(low=-1e10, high=1e10, shape=(1,)),
+            "steering": gym.spaces.Box(low=-1e10, high=1e10, shape=(1,)),
+            "ego_lane_dist": gym.spaces.Box(
+                low=-1e10, high=1e10, shape=(ego_lane_window,)
+            ),
+            "ego_ttc": gym.spaces.Box(low=-1e10, high=1e10, shape=(ego_lane_window,)),
+        }
+    )
+
+
+def _flat_slices(dict_space):
+    # gym.spaces.Dict sorts its keys, which is also the order RLlib's dict
+    # preprocessor flattens them in
+    slices = {}
+    start = 0
+    for key, space in dict_space.spaces.items():
+        slices[key] = slice(start, start + space.shape[0])
+        start += space.shape[0]
+    return slices
+
+
+def _flat_space(dict_space):
+    return gym.spaces.Box(
+        low=np.concatenate([s.low for s in dict_space.spaces.values()]),
+        high=np.concatenate([s.high for s in dict_space.spaces.values()]),
+        dtype=np.float32,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _flat_lane_ttc_observation_layout(ego_lane_window):
+    # (flat space, slice of every key in it), built once per window size
+    dict_space = _lane_ttc_observation_space(ego_lane_window)
+    return _flat_space(dict_space), _flat_slices(dict_space)
+
+
+_LANE_TTC_OBSERVATION_SPACE = _lane_ttc_observation_space()
+(
+    _FLAT_LANE_TTC_OBSERVATION_SPACE,
+    _FLAT_LANE_TTC_OBSERVATION_SLICES,
+) = _flat_lane_ttc_observation_layout(EGO_LANE_WINDOW)
+
+
+def _lane_ttc_observation_adapter(
+    env_observation, segment_cache=None, ego_lane_window=EGO_LANE_WINDOW
+):
     ego = env_observation.ego_vehicle_state
-    waypoint_paths = env_observation.waypoint_paths
-    wps = [path[0] for path in waypoint_paths]
-
-    # distance of vehicle from center of lane
-    closest_wp = min(wps, key=lambda wp: wp.dist_to(ego.position))
-    signed_dist_from_center = closest_wp.signed_lateral_error(ego.position)
-    lane_hwidth = closest_wp.lane_width * 0.5
-    norm_dist_from_center = signed_dist_from_center / lane_hwidth
+    closest_wp, norm_dist_from_center = _closest_wp_dist_from_center(env_observation)
 
-    ego_ttc, ego_lane_dist = _ego_ttc_lane_dist(env_observation, closest_wp.lane_index)
+    ego_ttc, ego_lane_dist = _ego_ttc_lane_dist(
+        env_observation, closest_wp.lane_index, segment_cache, ego_lane_window
+    )
 
     return {
         "distance_from_center": np.array([norm_dist_from_center]),
@@ -48,118 +95,694 @@ lane_ttc_observation_adapter = Adapter(
 )
 
 
-def _ego_ttc_lane_dist(env_observation, ego_lane_index):
-    ttc_by_p, lane_dist_by_p = _ttc_by_path(env_observation)
+def _lane_ttc_flat_observation_adapter(
+    env_observation, out=None, segment_cache=None, ego_lane_window=EGO_LANE_WINDOW
+):
+    # same values as _lane_ttc_observation_adapter, written straight into the
+    # flat float32 model input, pass `out` to reuse a preallocated buffer
+    space, slices = _flat_lane_ttc_observation_layout(ego_lane_window)
+    if out is None:
+        out = np.empty(space.shape, dtype=np.float32)
+
+    ego = env_observation.ego_vehicle_state
+    closest_wp, norm_dist_from_center = _closest_wp_dist_from_center(env_observation)
+
+    ego_ttc, ego_lane_dist = _ego_ttc_lane_dist(
+        env_observation, closest_wp.lane_index, segment_cache, ego_lane_window
+    )
+
+    out[slices["distance_from_center"]] = norm_dist_from_center
+    out[slices["angle_error"]] = closest_wp.relative_heading(ego.heading)
+    out[slices["speed"]] = ego.speed / 100
+    out[slices["steering"]] = ego.steering / 45
+    out[slices["ego_ttc"]] = ego_ttc
+    out[slices["ego_lane_dist"]] = ego_lane_dist
+
+    return out
+
+
+lane_ttc_flat_observation_adapter = Adapter(
+    space=_FLAT_LANE_TTC_OBSERVATION_SPACE, transform=_lane_ttc_flat_observation_adapter
+)
+
+
+class _IncrementalLaneTTCTransform:
+    def __init__(self, transform, ego_lane_window=EGO_LANE_WINDOW):
+        self._transform = transform
+        self._ego_lane_window = ego_lane_window
+        self._segment_cache = _SegmentLengthCache()
+
+    def __call__(self, env_observation):
+        return self._transform(
+            env_observation,
+            segment_cache=self._segment_cache,
+            ego_lane_window=self._ego_lane_window,
+        )
+
+    def reset(self):
+        self._segment_cache.reset()
+
+
+def incremental_lane_ttc_observation_adapter(
+    flat=False, ego_lane_window=EGO_LANE_WINDOW
+):
+    """Returns a new lane ttc adapter (the flat one if `flat`) that reuses the
+    waypoint segment lengths of the previous step. It is stateful, so create
+    one per agent and call `adapter.transform.reset()` before `env.reset()`.
+
+    `ego_lane_window` is the (odd) number of lanes around the ego lane in
+    "ego_ttc" and "ego_lane_dist", the space of the adapter follows it.
+    """
+    if flat:
+        space, _ = _flat_lane_ttc_observation_layout(ego_lane_window)
+        transform = _lane_ttc_flat_observation_adapter
+    else:
+        space = _lane_ttc_observation_space(ego_lane_window)
+        transform = _lane_ttc_observation_adapter
+    return Adapter(
+        space=space,
+        transform=_IncrementalLaneTTCTransform(transform, ego_lane_window),
+    )
+
+
+class _PreallocatedLaneTTCTransform:
+    """Writes the observation of every agent into buffers allocated the first
+    time the agent is seen and returns views into them, so no observation
+    arrays are allocated per step. The views are overwritten the next time
+    the same agent is transformed, copy them if they have to outlive a step.
+    """
+
+    def __init__(self, flat=False, ego_lane_window=EGO_LANE_WINDOW, check=False):
+        self._flat = flat
+        self._ego_lane_window = ego_lane_window
+        self._check = check
+        if check and not tracemalloc.is_tracing():
+            # arrays that a step frees have to be traced since their
+            # allocation to be told apart from new ones, so it stays on
+            tracemalloc.start(_TRACEBACK_FRAMES)
+        self._slices = _flat_lane_ttc_observation_layout(ego_lane_window)[1]
+        # {ego vehicle id: (buffer, observation of views, segment cache)}
+        self._agent_buffers = {}
+        self._free_buffers = []
+
+    def __call__(self, env_observation):
+        vehicle_id = env_observation.ego_vehicle_state.id
+        agent_buffers = self._agent_buffers.get(vehicle_id)
+        if agent_buffers is None:
+            if self._free_buffers:
+                agent_buffers = self._free_buffers.pop()
+            else:
+                agent_buffers = self._allocate()
+            self._agent_buffers[vehicle_id] = agent_buffers
+        elif self._check:
+            with _no_new_numpy_arrays():
+                return self._fill(env_observation, *agent_buffers)
+
+        return self._fill(env_observation, *agent_buffers)
+
+    def reset(self):
+        # ego vehicle ids change every episode, keep their buffers for the
+        # agents of the next one
+        for _, _, segment_cache in self._agent_buffers.values():
+            segment_cache.reset()
+        self._free_buffers.extend(self._agent_buffers.values())
+        self._agent_buffers.clear()
+
+    def _allocate(self):
+        size = self._slices["steering"].stop
+        if self._flat:
+            buffer = np.zeros(size, dtype=np.float32)
+            return buffer, buffer, _SegmentLengthCache()
+
+        # same dtype as the arrays of _lane_ttc_observation_adapter
+        buffer = np.zeros(size)
+        observation = {key: buffer[s] for key, s in self._slices.items()}
+        return buffer, observation, _SegmentLengthCache()
+
+    def _fill(self, env_observation, buffer, observation, segment_cache):
+        _lane_ttc_flat_observation_adapter(
+            env_observation,
+            out=buffer,
+            segment_cache=segment_cache,
+            ego_lane_window=self._ego_lane_window,
+        )
+        return observation
+
+
+def preallocated_lane_ttc_observation_adapter(
+    flat=False, ego_lane_window=EGO_LANE_WINDOW, check_allocations=False
+):
+    """Returns a new lane ttc adapter (the flat one if `flat`) that fills
+    preallocated per-agent buffers in place and returns views into them.
+    Like the incremental adapter it reuses the segment lengths of the
+    previous step, call `adapter.transform.reset()` before `env.reset()`.
+
+    The views are overwritten on the next step, so only use it where the
+    observation is consumed right away, like policy inference or RLlib's
+    dict preprocessor, which copies it. With `check_allocations` every step
+    raises an AssertionError if the adapter left more numpy arrays alive than
+    before it, this starts tracemalloc for the rest of the process, is slow
+    and meant for debugging.
+    """
+    if flat:
+        space, _ = _flat_lane_ttc_observation_layout(ego_lane_window)
+    else:
+        space = _lane_ttc_observation_space(ego_lane_window)
+    return Adapter(
+        space=space,
+        transform=_PreallocatedLaneTTCTransform(
+            flat, ego_lane_window, check=check_allocations
+        ),
+    )
+
+
+# frames kept per allocation, enough to get from numpy's own functions, like
+# np.full, back to the call in this file
+_TRACEBACK_FRAMES = 16
+
+
+@contextlib.contextmanager
+def _no_new_numpy_arrays():
+    """Asserts that the block leaves no more numpy arrays alive than before
+    it, counting the arrays allocated directly or through any call made from
+    this file. Needs tracemalloc to trace `_TRACEBACK_FRAMES` frames.
+
+    Arrays allocated within `_LaneTreeCache` are not counted: it keeps the
+    tree of every long lane it meets across steps, up to `MAX_LANES`, so the
+    first step on a new lane adds arrays by design.
+    """
+    if (
+        not tracemalloc.is_tracing()
+        or tracemalloc.get_traceback_limit() < _TRACEBACK_FRAMES
+    ):
+        raise RuntimeError(
+            f"tracemalloc has to trace at least {_TRACEBACK_FRAMES} frames to "
+            "check the allocations of the observation adapter"
+        )
+
+    before = _numpy_traces_from_here()
+    yield
+    after = _numpy_traces_from_here()
+
+    # arrays that replace an older one, like the ones of the segment cache,
+    # leave the count unchanged
+    stats = after.compare_to(before, "traceback")
+    if sum(stat.count_diff for stat in stats) > 0:
+        raise AssertionError(
+            "observation adapter allocated numpy arrays:\n"
+            + "\n".join(
+                "\n".join([str(stat)] + stat.traceback.format())
+                for stat in stats
+                if stat.count_diff > 0
+            )
+        )
+
+
+def _numpy_traces_from_here():
+    # a trace has to match one of the include filters, so apply them in turn
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces(
+        [tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)]
+    )
+    snapshot = snapshot.filter_traces(
+        [tracemalloc.Filter(True, __file__, all_frames=True)]
+    )
+    return snapshot.filter_traces(_lane_tree_cache_filters())
+
+
+@functools.lru_cache(maxsize=None)
+def _lane_tree_cache_filters():
+    # a filter matches a single line, so exclude every line of the class,
+    # any frame in it excludes the trace
+    lines, first = inspect.getsourcelines(_LaneTreeCache)
+    return [
+        tracemalloc.Filter(False, __file__, lineno, all_frames=True)
+        for lineno in range(first, first + len(lines))
+    ]
+
+
+def lane_ttc_observation_batch_transform(
+    env_observations, ego_lane_window=EGO_LANE_WINDOW
+):
+    """Transforms the {agent_id: env_observation} dict of all agents at once.
+
+    Returns the agent ids in batch order and a dict with the keys of the
+    lane ttc observation space, where every value stacks the observations of
+    all agents along the first axis, ie. batch["ego_ttc"][i] is the "ego_ttc"
+    of agent_ids[i].
+    """
+    agent_ids = list(env_observations)
+    observations = [env_observations[agent_id] for agent_id in agent_ids]
+
+    batch = {
+        key: np.zeros((len(agent_ids),) + space.shape)
+        for key, space in _lane_ttc_observation_space(ego_lane_window).spaces.items()
+    }
+
+    # the neighbour ttc of all agents is computed in a single pass
+    ttc_lane_dist_by_path = _ttc_by_paths(observations, ego_lane_window=ego_lane_window)
+
+    for i, env_observation in enumerate(observations):
+        ego = env_observation.ego_vehicle_state
+        closest_wp, norm_dist_from_center = _closest_wp_dist_from_center(
+            env_observation
+        )
+        ttc_by_p, lane_dist_by_p = ttc_lane_dist_by_path[i]
+        ego_ttc, ego_lane_dist = _ego_ttc_calc(
+            closest_wp.lane_index, ttc_by_p, lane_dist_by_p, ego_lane_window
+        )
+
+        batch["distance_from_center"][i] = norm_dist_from_center
+        batch["angle_error"][i] = closest_wp.relative_heading(ego.heading)
+        batch["speed"][i] = ego.speed / 100
+        batch["steering"][i] = ego.steering / 45
+        batch["ego_ttc"][i] = ego_ttc
+        batch["ego_lane_dist"][i] = ego_lane_dist
+
+    return agent_ids, batch
+
 
-    return _ego_ttc_calc(ego_lane_index, ttc_by_p, lane_dist_by_p)
+def split_observation_batch(agent_ids, batch):
+    # views into the batch arrays, one observation dict per agent
+    return {
+        agent_id: {key: values[i] for key, values in batch.items()}
+        for i, agent_id in enumerate(agent_ids)
+    }
 
 
-def _ttc_by_path(env_observation):
+def _closest_wp_dist_from_center(env_observation):
     ego = env_observation.ego_vehicle_state
     waypoint_paths = env_observation.waypoint_paths
-    neighborhood_vehicle_states = env_observation.neighborhood_vehicle_states
-
-    # first sum up the distance between waypoints along a path
-    # ie. [(wp1, path1, 0),
-    #      (wp2, path1, 0 + dist(wp1, wp2)),
-    #      (wp3, path1, 0 + dist(wp1, wp2) + dist(wp2, wp3))]
-
-    wps_with_lane_dist = []
-    for path_idx, path in enumerate(waypoint_paths):
-        lane_dist = 0.0
-        for w1, w2 in zip(path, path[1:]):
-            wps_with_lane_dist.append((w1, path_idx, lane_dist))
-            lane_dist += np.linalg.norm(w2.pos - w1.pos)
-        wps_with_lane_dist.append((path[-1], path_idx, lane_dist))
-
-    # next we compute the TTC along each of the paths
-    ttc_by_path_index = [1] * len(waypoint_paths)
-    lane_dist_by_path_index = [1] * len(waypoint_paths)
-
-    for v in neighborhood_vehicle_states:
-        # find all waypoints that are on the same lane as this vehicle
-        wps_on_lane = [
-            (wp, path_idx, dist)
-            for wp, path_idx, dist in wps_with_lane_dist
-            if wp.lane_id == v.lane_id
-        ]
+    wps = [path[0] for path in waypoint_paths]
 
-        if not wps_on_lane:
-            # this vehicle is not on a nearby lane
-            continue
+    # distance of vehicle from center of lane
+    closest_wp = min(wps, key=lambda wp: wp.dist_to(ego.position))
+    signed_dist_from_center = closest_wp.signed_lateral_error(ego.position)
+    lane_hwidth = closest_wp.lane_width * 0.5
+    norm_dist_from_center = signed_dist_from_center / lane_hwidth
 
-        # find the closest waypoint on this lane to this vehicle
-        nearest_wp, path_idx, lane_dist = min(
-            wps_on_lane, key=lambda tup: np.linalg.norm(tup[0].pos - vec_2d(v.position))
+    return closest_wp, norm_dist_from_center
+
+
+def _ego_ttc_lane_dist(
+    env_observation, ego_lane_index, segment_cache=None, ego_lane_window=EGO_LANE_WINDOW
+):
+    ttc_by_p, lane_dist_by_p = _ttc_by_path(
+        env_observation, segment_cache, ego_lane_window
+    )
+
+    return _ego_ttc_calc(ego_lane_index, ttc_by_p, lane_dist_by_p, ego_lane_window)
+
+
+def _ttc_by_path(env_observation, segment_cache=None, ego_lane_window=EGO_LANE_WINDOW):
+    return _ttc_by_paths([env_observation], segment_cache, ego_lane_window)[0]
+
+
+@functools.lru_cache(maxsize=1024)
+def _padded_path_layout(num_paths, half_window):
+    # the values of the paths of every observation, padded with half a window
+    # of 0 on both sides, so that the ego window is one slice of them. Returns
+    # the default values (1 for every path), where every observation starts
+    # and the index of every path in them
+    defaults = []
+    starts = []
+    path_slots = []
+    for n in num_paths:
+        starts.append(len(defaults))
+        first = len(defaults) + half_window
+        path_slots.extend(range(first, first + n))
+        defaults += [0] * half_window + [1] * n + [0] * half_window
+    return tuple(defaults), tuple(starts), tuple(path_slots)
+
+
+def _ttc_by_paths(
+    env_observations, segment_cache=None, ego_lane_window=EGO_LANE_WINDOW
+):
+    # returns (ttc_by_path_index, lane_dist_by_path_index) for every
+    # observation, padded for _ego_ttc_calc, the waypoints and neighbours of
+    # all observations are packed together so the work is vectorized across
+    # agents
+    num_paths = [len(obs.waypoint_paths) for obs in env_observations]
+    half_window = ego_lane_window // 2
+    defaults, starts, path_slots = _padded_path_layout(tuple(num_paths), half_window)
+    ttc_by_path_index = list(defaults)
+    lane_dist_by_path_index = list(defaults)
+
+    neighbours = [
+        (obs_idx, v)
+        for obs_idx, obs in enumerate(env_observations)
+        for v in obs.neighborhood_vehicle_states or []
+    ]
+
+    if neighbours:
+        waypoint_paths = [
+            path for obs in env_observations for path in obs.waypoint_paths
+        ]
+        wp_pos, wp_ids, wp_path_idx, wp_lane_dist, wp_lane_id = _pack_waypoint_paths(
+            waypoint_paths, segment_cache
+        )
+        path_obs_idx = np.repeat(np.arange(len(env_observations)), num_paths)
+        wp_obs_idx = path_obs_idx[wp_path_idx]
+
+        v_obs_idx = np.array([obs_idx for obs_idx, _ in neighbours])
+        v_pos = np.array([vec_2d(v.position) for _, v in neighbours])
+        v_speed = np.array([v.speed for _, v in neighbours])
+        v_lane_id = np.array([v.lane_id for _, v in neighbours])
+        ego_speed = np.array([obs.ego_vehicle_state.speed for obs in env_observations])
+
+        # a vehicle only shares a lane with the waypoints of its own observation
+        lane_ids, lane_codes = np.unique(
+            np.concatenate([wp_lane_id, v_lane_id]), return_inverse=True
         )
+        wp_lane_key = wp_obs_idx * len(lane_ids) + lane_codes[: len(wp_lane_id)]
+        v_lane_key = v_obs_idx * len(lane_ids) + lane_codes[len(wp_lane_id) :]
+
+        # find the closest waypoint on the same lane as each vehicle
+        lane_index = _LaneIndex(wp_lane_key, wp_pos, wp_ids, wp_lane_id)
+        nearest, nearest_dist = lane_index.nearest(v_lane_key, v_pos)
 
-        if np.linalg.norm(nearest_wp.pos - vec_2d(v.position)) > 2:
-            # this vehicle is not close enough to the path, this can happen
-            # if the vehicle is behind the ego, or ahead past the end of
-            # the waypoints
-            continue
+        # vehicles that are not on a nearby lane are left at inf, vehicles that
+        # are not close enough to the path can be behind the ego, or ahead past
+        # the end of the waypoints
+        valid = nearest_dist <= 2
+        nearest = nearest[valid]
 
-        relative_speed_m_per_s = (ego.speed - v.speed) * 1000 / 3600
-        if abs(relative_speed_m_per_s) < 1e-5:
-            relative_speed_m_per_s = 1e-5
+        path_idx = wp_path_idx[nearest]
+        lane_dist = wp_lane_dist[nearest]
+
+        relative_speed_m_per_s = (
+            (ego_speed[v_obs_idx[valid]] - v_speed[valid]) * 1000 / 3600
+        )
+        relative_speed_m_per_s[np.abs(relative_speed_m_per_s) < 1e-5] = 1e-5
 
         ttc = lane_dist / relative_speed_m_per_s
         ttc /= 10
-        if ttc <= 0:
-            # discard collisions that would have happened in the past
-            continue
 
-        lane_dist /= 100
-        lane_dist_by_path_index[path_idx] = min(
-            lane_dist_by_path_index[path_idx], lane_dist
+        # discard collisions that would have happened in the past
+        future = ttc > 0
+        path_idx = path_idx[future]
+        ttc = ttc[future]
+        lane_dist = lane_dist[future] / 100
+
+        _min_by_path(ttc_by_path_index, path_slots, path_idx, ttc)
+        _min_by_path(lane_dist_by_path_index, path_slots, path_idx, lane_dist)
+
+    ttc_lane_dist_by_path = []
+    for start, n in zip(starts, num_paths):
+        end = start + n + 2 * half_window
+        ttc_lane_dist_by_path.append(
+            (ttc_by_path_index[start:end], lane_dist_by_path_index[start:end])
         )
-        ttc_by_path_index[path_idx] = min(ttc_by_path_index[path_idx], ttc)
-
-    return ttc_by_path_index, lane_dist_by_path_index
-
-
-## original function extended to support 5 lanes
-def _ego_ttc_calc(ego_lane_index, ttc_by_path, lane_dist_by_path):
-    # ttc, lane distance from ego perspective
-
-    ego_ttc = [0] * 5
-    ego_lane_dist = [0] * 5
-
-    # current lane is centre
-    ego_ttc[2] = ttc_by_path[ego_lane_index]
-    ego_lane_dist[2] = lane_dist_by_path[ego_lane_index]
-
-    max_lane_index = len(ttc_by_path) - 1
-    min_lane_index = 0
-    if ego_lane_index + 1 > max_lane_index:
-        ego_ttc[3] = 0
-        ego_lane_dist[3] = 0
-        ego_ttc[4] = 0
-        ego_lane_dist[4] = 0
-    elif ego_lane_index + 2 > max_lane_index:
-        ego_ttc[3] = ttc_by_path[ego_lane_index + 1]
-        ego_lane_dist[3] = lane_dist_by_path[ego_lane_index + 1]
-        ego_ttc[4] = 0
-        ego_lane_dist[4] = 0
-    else:
-        ego_ttc[3] = ttc_by_path[ego_lane_index + 1]
-        ego_lane_dist[3] = lane_dist_by_path[ego_lane_index + 1]
-        ego_ttc[4] = ttc_by_path[ego_lane_index + 2]
-        ego_lane_dist[4] = lane_dist_by_path[ego_lane_index + 2]
-
-    if ego_lane_index - 1 < min_lane_index:
-        ego_ttc[0] = 0
-        ego_lane_dist[0] = 0
-        ego_ttc[1] = 0
-        ego_lane_dist[1] = 0
-    elif ego_lane_index - 2 < min_lane_index:
-        ego_ttc[0] = 0
-        ego_lane_dist[0] = 0
-        ego_ttc[1] = ttc_by_path[ego_lane_index - 1]
-        ego_lane_dist[1] = lane_dist_by_path[ego_lane_index - 1]
+
+    return ttc_lane_dist_by_path
+
+
+def _pack_waypoint_paths(waypoint_paths, segment_cache=None):
+    # flatten all paths into contiguous arrays with one row per waypoint and
+    # sum up the distance between waypoints along each path
+    # ie. wp_pos       = [wp1.pos, wp2.pos, wp3.pos, ...]
+    #     wp_path_idx  = [path1, path1, path1, ...]
+    #     wp_lane_dist = [0,
+    #                     0 + dist(wp1, wp2),
+    #                     0 + dist(wp1, wp2) + dist(wp2, wp3), ...]
+    wps = [wp for path in waypoint_paths for wp in path]
+    path_lens = [len(path) for path in waypoint_paths]
+
+    wp_pos = np.array([wp.pos for wp in wps])
+    wp_ids = np.array([wp.id for wp in wps], dtype=np.int64)
+    wp_lane_id = np.array([wp.lane_id for wp in wps])
+    wp_path_idx = np.repeat(np.arange(len(waypoint_paths)), path_lens)
+
+    # segment lengths across path boundaries are computed too, but never used
+    if segment_cache is None:
+        segment_lens = _norms(np.diff(wp_pos, axis=0))
     else:
-        ego_ttc[0] = ttc_by_path[ego_lane_index - 2]
-        ego_lane_dist[0] = lane_dist_by_path[ego_lane_index - 2]
-        ego_ttc[1] = ttc_by_path[ego_lane_index - 1]
-        ego_lane_dist[1] = lane_dist_by_path[ego_lane_index - 1]
-    return ego_ttc, ego_lane_dist
+        segment_lens = segment_cache.segment_lengths(wp_ids, wp_pos)
+    wp_lane_dist = np.zeros(len(wps))
+    start = 0
+    for path_len in path_lens:
+        np.cumsum(
+            segment_lens[start : start + path_len - 1],
+            out=wp_lane_dist[start + 1 : start + path_len],
+        )
+        start += path_len
+
+    return wp_pos, wp_ids, wp_path_idx, wp_lane_dist, wp_lane_id
+
+
+class _SegmentLengthCache:
+    """Lengths of the segments between consecutive waypoints of the last
+    steps, keyed by the ids and positions of both waypoints. Waypoint paths
+    of consecutive steps mostly overlap, so only the new segments need to be
+    computed.
+    """
+
+    # segments kept from previous calls, beyond this only the latest call is
+    # kept, so the cache stays bounded when agents share an adapter
+    MAX_SEGMENTS = 4096
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._keys = np.empty(0, dtype=np.int64)
+        self._start_pos = np.empty((0, 2))
+        self._end_pos = np.empty((0, 2))
+        self._lens = np.empty(0)
+
+    def segment_lengths(self, wp_ids, wp_pos):
+        # waypoint ids are unique per road network and fit in 32 bits
+        keys = (wp_ids[:-1] << 32) | wp_ids[1:]
+        start_pos = wp_pos[:-1]
+        end_pos = wp_pos[1:]
+        lens = np.empty(len(keys))
+
+        slots = np.searchsorted(self._keys, keys)
+        slots = np.minimum(slots, max(len(self._keys) - 1, 0))
+        hit = np.zeros(len(keys), dtype=bool)
+        if len(self._keys):
+            # ids restart for every road network, so check both ends too
+            hit = (
+                (self._keys[slots] == keys)
+                & np.all(self._start_pos[slots] == start_pos, axis=1)
+                & np.all(self._end_pos[slots] == end_pos, axis=1)
+            )
+            lens[hit] = self._lens[slots[hit]]
+
+        miss = ~hit
+        lens[miss] = _norms(end_pos[miss] - start_pos[miss])
+
+        if len(self._keys) + len(keys) > self.MAX_SEGMENTS:
+            self._store(keys, start_pos, end_pos, lens)
+        else:
+            self._store(
+                np.concatenate([keys[miss], self._keys]),
+                np.concatenate([start_pos[miss], self._start_pos]),
+                np.concatenate([end_pos[miss], self._end_pos]),
+                np.concatenate([lens[miss], self._lens]),
+            )
+
+        return lens
+
+    def _store(self, keys, start_pos, end_pos, lens):
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._start_pos = start_pos[order]
+        self._end_pos = end_pos[order]
+        self._lens = lens[order]
+
+
+class _LaneTreeCache:
+    """KD-trees over the waypoints of long lanes, kept across steps and
+    shared by all agents of the process.
+
+    Waypoints keep their id and position, and the path on a lane moves by a
+    few of them per step. So the tree of a lane is only rebuilt once the
+    waypoints it lacks are more than a quarter of the path, with all the
+    waypoints seen on the lane, and soon holds the whole lane. The waypoints
+    it lacks are compared one by one.
+    """
+
+    # lanes kept, the least recently used one is dropped beyond it
+    MAX_LANES = 256
+    # a tree holding more waypoints is rebuilt from the current path only
+    MAX_LANE_WAYPOINTS = 8192
+    # nearest tree waypoints searched for one on the current path
+    CANDIDATES = 8
+
+    def __init__(self):
+        # {lane id: (waypoint ids, positions, ids sorted, their order, tree)}
+        self._lanes = {}
+
+    def nearest(self, lane_id, wp_ids, wp_pos, points):
+        """Returns the index into `wp_ids` of the waypoint closest to each
+        of `points` and the distance to it.
+        """
+        # popped and reinserted, so the dict is in least recently used order
+        entry = self._lanes.pop(lane_id, None)
+        if entry is not None:
+            tree_idx, known = self._lookup(entry, wp_ids, wp_pos)
+            if tree_idx is None:
+                entry = None
+        if entry is None:
+            entry = self._build(wp_ids, wp_pos)
+            tree_idx, known = self._lookup(entry, wp_ids, wp_pos)
+        elif 4 * np.count_nonzero(~known) > len(wp_ids):
+            # branching paths share waypoints, add each one once
+            _, new = np.unique(wp_ids[~known], return_index=True)
+            new = np.flatnonzero(~known)[new]
+            if len(entry[0]) + len(new) <= self.MAX_LANE_WAYPOINTS:
+                entry = self._build(
+                    np.concatenate([entry[0], wp_ids[new]]),
+                    np.concatenate([entry[1], wp_pos[new]]),
+                )
+            else:
+                entry = self._build(wp_ids, wp_pos)
+            tree_idx, known = self._lookup(entry, wp_ids, wp_pos)
+        self._lanes[lane_id] = entry
+        if len(self._lanes) > self.MAX_LANES:
+            del self._lanes[next(iter(self._lanes))]
+
+        tree_ids, _, _, _, tree = entry
+        # tree waypoint -> its first index in wp_ids, -1 off the current path,
+        # so ties resolve like the linear scan
+        on_path = np.full(len(tree_ids), len(wp_ids))
+        np.minimum.at(on_path, tree_idx[known], np.flatnonzero(known))
+        on_path[on_path == len(wp_ids)] = -1
+
+        k = min(self.CANDIDATES, len(tree_ids))
+        candidates = on_path[tree.query(points, k=k, return_distance=False)]
+        found = candidates >= 0
+        idx = candidates[np.arange(len(points)), np.argmax(found, axis=1)]
+
+        # every candidate is off the path, e.g. behind the ego
+        missed = np.flatnonzero(~found.any(axis=1))
+        if len(missed):
+            missed_dists = _norms(
+                wp_pos[np.newaxis, :, :] - points[missed][:, np.newaxis, :]
+            )
+            idx[missed] = np.argmin(missed_dists, axis=1)
+        dists = _norms(wp_pos[idx] - points)
+
+        unknown = np.flatnonzero(~known)
+        if len(unknown):
+            unknown_dists = _norms(
+                wp_pos[unknown][np.newaxis, :, :] - points[:, np.newaxis, :]
+            )
+            closest = np.argmin(unknown_dists, axis=1)
+            closest_dists = unknown_dists[np.arange(len(points)), closest]
+            closer = closest_dists < dists
+            idx[closer] = unknown[closest[closer]]
+            dists[closer] = closest_dists[closer]
+
+        return idx, dists
+
+    def _build(self, tree_ids, tree_pos):
+        from sklearn.neighbors import KDTree
+
+        # the waypoints of a step are views into the arrays of all its lanes,
+        # copy them so that the entry does not keep those alive
+        tree_ids = tree_ids.copy()
+        tree_pos = tree_pos.copy()
+        order = np.argsort(tree_ids, kind="stable")
+        tree = KDTree(tree_pos, leaf_size=32)
+        return tree_ids, tree_pos, tree_ids[order], order, tree
+
+    def _lookup(self, entry, wp_ids, wp_pos):
+        # tree index of every waypoint and whether the tree has it, or None
+        # if a waypoint moved, as ids restart for every road network
+        _, tree_pos, sorted_ids, order, _ = entry
+        slots = np.minimum(np.searchsorted(sorted_ids, wp_ids), len(sorted_ids) - 1)
+        tree_idx = order[slots]
+        known = sorted_ids[slots] == wp_ids
+        if not np.array_equal(tree_pos[tree_idx[known]], wp_pos[known]):
+            return None, None
+        return tree_idx, known
+
+
+# one per process, like the lane caches of SMARTS' waypoints
+_lane_trees = _LaneTreeCache()
+
+
+class _LaneIndex:
+    """Waypoints grouped by lane, built once per step so that each neighbour
+    is only compared against the waypoints on its own lane.
+    """
+
+    def __init__(self, wp_lane_keys, wp_pos, wp_ids, wp_lane_id):
+        # a stable sort keeps the path order of waypoints within each lane,
+        # so ties resolve to the same waypoint as a linear scan would
+        self._order = np.argsort(wp_lane_keys, kind="stable")
+        self._pos = wp_pos[self._order]
+        self._ids = wp_ids[self._order]
+        self._lane_id = wp_lane_id[self._order]
+        self._keys, self._starts, self._counts = np.unique(
+            wp_lane_keys[self._order], return_index=True, return_counts=True
+        )
+
+    def nearest(self, lane_keys, points):
+        """Returns the index of the closest waypoint on the given lanes and
+        the distance to it, or (-1, inf) for points on lanes without waypoints.
+        """
+        nearest = np.full(len(lane_keys), -1)
+        nearest_dist = np.full(len(lane_keys), np.inf)
+        if len(self._keys) == 0:
+            return nearest, nearest_dist
+
+        slots = np.searchsorted(self._keys, lane_keys)
+        slots = np.minimum(slots, len(self._keys) - 1)
+        on_lane = self._keys[slots] == lane_keys
+
+        for slot in np.unique(slots[on_lane]):
+            queries = np.flatnonzero(on_lane & (slots == slot))
+            start = self._starts[slot]
+            end = start + self._counts[slot]
+            lane_pos = self._pos[start:end]
+
+            if len(lane_pos) >= _KD_TREE_MIN_LANE_WAYPOINTS:
+                lane_id = self._lane_id[start]
+                idx, dists = _lane_trees.nearest(
+                    lane_id, self._ids[start:end], lane_pos, points[queries]
+                )
+            else:
+                lane_dists = _norms(
+                    lane_pos[np.newaxis, :, :] - points[queries][:, np.newaxis, :]
+                )
+                idx = np.argmin(lane_dists, axis=1)
+                dists = lane_dists[np.arange(len(idx)), idx]
+
+            nearest[queries] = self._order[start + idx]
+            nearest_dist[queries] = dists
+
+        return nearest, nearest_dist
+
+
+def _norms(vectors):
+    # euclidean norm over the last axis, reduced with one dot product per
+    # vector so that the result matches np.linalg.norm(vector) bit for bit
+    squared = np.matmul(vectors[..., np.newaxis, :], vectors[..., np.newaxis])
+    return np.sqrt(squared[..., 0, 0])
+
+
+def _min_by_path(values_by_path_index, path_slots, path_idx, values):
+    mins = np.ones(len(path_slots))
+    np.minimum.at(mins, path_idx, values)
+
+    # paths that kept their default stay the int 1 as in a python min(1, x)
+    for i in np.flatnonzero(mins < 1):
+        values_by_path_index[path_slots[i]] = mins[i]
+
+
+def _ego_ttc_calc(
+    ego_lane_index, ttc_by_path, lane_dist_by_path, ego_lane_window=EGO_LANE_WINDOW
+):
+    # ttc, lane distance from ego perspective, the current lane is the centre
+    # of the window and lanes past either edge of the road are 0. The values
+    # by path come padded with half a window of 0 (see _ttc_by_paths), so the
+    # window is one slice of them
+    # ie. with a window of 5 and 3 paths, ego on path 0
+    #     ttc_by_path = [0, 0, p0, p1, p2, 0, 0]
+    #     ego_ttc     = ttc_by_path[0 : 5] = [0, 0, p0, p1, p2]
+    end = ego_lane_index + ego_lane_window
+    return ttc_by_path[ego_lane_index:end], lane_dist_by_path[ego_lane_index:end]
+
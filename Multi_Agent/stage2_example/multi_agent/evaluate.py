@@ -0,0 +1,196 @@
+# this file is for evaluating agents on several envs stepped in lock-step
+import argparse
+import multiprocessing
+from pathlib import Path
+from collections import defaultdict
+
+import numpy as np
+
+
+scenario_dir = (Path(__file__).parent / "f1_public").resolve()
+scenario_names = ["shanghai", "silverstone", "monte", "interlagos"]
+scenario_paths = [scenario_dir / name for name in scenario_names]
+
+
+def _agent_ids(num_agents):
+    return [f"Agent-{i:03d}" for i in range(7, 7 + num_agents)]
+
+
+def _env_worker(conn, scenario_path, seed, num_agents, headless):
+    # runs in its own process, hosts one env and steps it on request
+    import gym
+    from agent import flat_agent, reset_observation_adapters
+
+    env = gym.make(
+        "smarts.env:hiway-v0",
+        scenarios=[scenario_path],
+        agents={agent_id: flat_agent for agent_id in _agent_ids(num_agents)},
+        headless=headless,
+        visdom=False,
+        seed=seed,
+    )
+
+    try:
+        while True:
+            command, actions = conn.recv()
+            if command == "reset":
+                reset_observation_adapters()
+                conn.send(env.reset())
+            elif command == "step":
+                observations, rewards, dones, infos = env.step(actions)
+                # infos also hold the raw env observations, only send the scores
+                scores = {agent_id: info["score"] for agent_id, info in infos.items()}
+                conn.send((observations, rewards, dones, scores))
+            elif command == "close":
+                break
+    finally:
+        env.close()
+        conn.close()
+
+
+class VectorizedEvaluator:
+    """Runs one env per process, env i on scenario i % len(scenarios), and
+    steps all of them in lock-step so every tick needs one batched policy
+    call for the agents of all envs.
+    """
+
+    def __init__(self, scenarios, num_envs, seed=42, num_agents=1, headless=True):
+        self._scenario_names = []
+        self._conns = []
+        self._procs = []
+
+        # spawn, forking a process that already holds a tf session is unsafe
+        ctx = multiprocessing.get_context("spawn")
+        for env_idx in range(num_envs):
+            scenario_path = Path(scenarios[env_idx % len(scenarios)])
+            env_seed = seed + env_idx
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(
+                target=_env_worker,
+                args=(child_conn, str(scenario_path), env_seed, num_agents, headless),
+                daemon=True,
+            )
+            proc.start()
+            child_conn.close()
+
+            self._scenario_names.append(scenario_path.name)
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+
+    def evaluate(self, policy, episodes_per_env):
+        """Returns {scenario_name: {"reward": [...], "distance": [...]}} with
+        one entry per finished episode.
+        """
+        stats = defaultdict(lambda: {"reward": [], "distance": []})
+        num_envs = len(self._conns)
+        episodes_left = [episodes_per_env] * num_envs
+        episode_rewards = [0.0] * num_envs
+        episode_scores = [{} for _ in range(num_envs)]
+
+        for conn in self._conns:
+            conn.send(("reset", None))
+        observations = [conn.recv() for conn in self._conns]
+        running = list(range(num_envs))
+
+        while running:
+            # one policy call for all agents of all running envs
+            actions = policy.act_batch(
+                {
+                    (env_idx, agent_id): obs
+                    for env_idx in running
+                    for agent_id, obs in observations[env_idx].items()
+                }
+            )
+            for env_idx in running:
+                env_actions = {
+                    agent_id: actions[(env_idx, agent_id)]
+                    for agent_id in observations[env_idx]
+                }
+                self._conns[env_idx].send(("step", env_actions))
+
+            resets = []
+            for env_idx in running:
+                obs, rewards, dones, scores = self._conns[env_idx].recv()
+                observations[env_idx] = obs
+                episode_rewards[env_idx] += sum(rewards.values())
+                episode_scores[env_idx].update(scores)
+                if not dones["__all__"]:
+                    continue
+
+                scenario_stats = stats[self._scenario_names[env_idx]]
+                scenario_stats["reward"].append(episode_rewards[env_idx])
+                scenario_stats["distance"].append(
+                    np.mean(list(episode_scores[env_idx].values()))
+                )
+                episode_rewards[env_idx] = 0.0
+                episode_scores[env_idx] = {}
+                episodes_left[env_idx] -= 1
+                if episodes_left[env_idx] > 0:
+                    resets.append(env_idx)
+
+            for env_idx in resets:
+                self._conns[env_idx].send(("reset", None))
+            for env_idx in resets:
+                observations[env_idx] = self._conns[env_idx].recv()
+
+            running = [env_idx for env_idx in running if episodes_left[env_idx] > 0]
+
+        return dict(stats)
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(("close", None))
+        for proc in self._procs:
+            proc.join()
+
+
+def main(args):
+    from agent import flat_agent
+
+    evaluator = VectorizedEvaluator(
+        scenario_paths,
+        num_envs=args.num_envs,
+        seed=args.seed,
+        num_agents=args.num_agents,
+        headless=args.headless,
+    )
+    flat_agent.policy.setup()
+
+    try:
+        stats = evaluator.evaluate(flat_agent.policy, args.episodes)
+    finally:
+        evaluator.close()
+
+    print(f"{'scenario':<15} {'episodes':>8} {'reward':>18} {'distance':>18}")
+    for name in scenario_names:
+        if name not in stats:
+            continue
+        rewards = stats[name]["reward"]
+        distances = stats[name]["distance"]
+        print(
+            f"{name:<15} {len(rewards):>8} "
+            f"{np.mean(rewards):>10.2f} ± {np.std(rewards):<6.2f} "
+            f"{np.mean(distances):>10.2f} ± {np.std(distances):<6.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("vectorized-evaluation")
+    parser.add_argument(
+        "--num_envs",
+        type=int,
+        default=len(scenario_names),
+        help="Number of envs, assigned to the scenarios round robin",
+    )
+    parser.add_argument(
+        "--episodes", type=int, default=1, help="Number of episodes per env"
+    )
+    parser.add_argument(
+        "--num_agents", type=int, default=1, help="Number of agents sharing the policy"
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the first env")
+    parser.add_argument(
+        "--headless", help="run simulation in headless mode", action="store_true",
+    )
+    args = parser.parse_args()
+    main(args)
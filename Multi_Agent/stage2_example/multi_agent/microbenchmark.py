@@ -0,0 +1,240 @@
+# this file is for timing custom_observations.py without a simulation
+import json
+import timeit
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from smarts.core.utils.math import degrees_to_vec, signed_dist_to_line, vec_2d
+
+import custom_observations
+
+
+#########################################
+# stand-ins for the smarts observation types, only the fields and methods
+# custom_observations.py uses
+#########################################
+Observation = namedtuple(
+    "Observation",
+    ["ego_vehicle_state", "neighborhood_vehicle_states", "waypoint_paths"],
+)
+
+VehicleState = namedtuple(
+    "VehicleState",
+    ["id", "position", "heading", "speed", "steering", "lane_id", "lane_index"],
+)
+
+
+_WaypointFields = namedtuple(
+    "Waypoint", ["id", "pos", "heading", "lane_width", "lane_id", "lane_index"]
+)
+
+
+class Waypoint(_WaypointFields):
+    # same math as smarts.core.waypoints.Waypoint
+    __slots__ = ()
+
+    def dist_to(self, p):
+        return np.linalg.norm(self.pos - vec_2d(p))
+
+    def relative_heading(self, h):
+        rel_heading = self.heading - h
+        if rel_heading > 180:
+            rel_heading -= 360
+        if rel_heading < -180:
+            rel_heading += 360
+        return rel_heading
+
+    def signed_lateral_error(self, p):
+        return signed_dist_to_line(p, self.pos, degrees_to_vec(self.heading))
+
+
+LANE_WIDTH = 3.2
+WAYPOINT_SPACING = 1.0
+
+
+def make_observation(num_lanes, num_neighbours, path_len=50, seed=42):
+    """A straight road heading +y with `num_lanes` lanes, one waypoint path
+    per lane, the ego in the middle lane and `num_neighbours` vehicles spread
+    over the lanes, some behind the ego and some ahead of the paths.
+    """
+    rng = np.random.RandomState(seed)
+
+    def lane_x(lane_index):
+        # lane 0 is the outer(right) most lane
+        return (num_lanes - 1 - lane_index) * LANE_WIDTH
+
+    waypoint_paths = [
+        [
+            Waypoint(
+                id=lane_index * path_len + i,
+                pos=np.array([lane_x(lane_index), i * WAYPOINT_SPACING]),
+                heading=0.0,
+                lane_width=LANE_WIDTH,
+                lane_id=f"road_{lane_index}",
+                lane_index=lane_index,
+            )
+            for i in range(path_len)
+        ]
+        for lane_index in range(num_lanes)
+    ]
+
+    ego_lane_index = num_lanes // 2
+    ego = VehicleState(
+        id="Agent-007",
+        position=np.array([lane_x(ego_lane_index) + 0.3, 0.2, 0.0]),
+        heading=1.5,
+        speed=rng.uniform(40, 80),
+        steering=rng.uniform(-5, 5),
+        lane_id=f"road_{ego_lane_index}",
+        lane_index=ego_lane_index,
+    )
+
+    neighbours = []
+    for i in range(num_neighbours):
+        lane_index = rng.randint(num_lanes)
+        neighbours.append(
+            VehicleState(
+                id=f"car-{i}",
+                position=np.array(
+                    [
+                        lane_x(lane_index) + rng.uniform(-0.5, 0.5),
+                        rng.uniform(-10, path_len * WAYPOINT_SPACING + 10),
+                        0.0,
+                    ]
+                ),
+                heading=rng.uniform(-3, 3),
+                speed=rng.uniform(20, 100),
+                steering=0.0,
+                lane_id=f"road_{lane_index}",
+                lane_index=lane_index,
+            )
+        )
+
+    return Observation(
+        ego_vehicle_state=ego,
+        neighborhood_vehicle_states=neighbours,
+        waypoint_paths=waypoint_paths,
+    )
+
+
+def _time_per_call_us(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    # the fastest run is the least disturbed by the rest of the machine
+    return 1e6 * min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def benchmark(
+    lane_counts, neighbour_counts, path_len, repeat, seed, check_allocations=False
+):
+    """Returns {function_name: {num_lanes: {num_neighbours: us_per_call}}}."""
+    results = {
+        "_lane_ttc_observation_adapter": {},
+        "preallocated_lane_ttc_observation_adapter": {},
+        "_ttc_by_path": {},
+        "_ego_ttc_calc": {},
+    }
+    preallocated = custom_observations.preallocated_lane_ttc_observation_adapter(
+        check_allocations=check_allocations
+    ).transform
+    for num_lanes in lane_counts:
+        for key in results:
+            results[key][num_lanes] = {}
+
+        for num_neighbours in neighbour_counts:
+            obs = make_observation(num_lanes, num_neighbours, path_len, seed)
+            # every fixture starts a new episode for the preallocated adapter
+            preallocated.reset()
+            ego_lane_index = obs.ego_vehicle_state.lane_index
+            ttc_by_p, lane_dist_by_p = custom_observations._ttc_by_path(obs)
+
+            timings = {
+                "_lane_ttc_observation_adapter": lambda: (
+                    custom_observations._lane_ttc_observation_adapter(obs)
+                ),
+                "preallocated_lane_ttc_observation_adapter": lambda: preallocated(obs),
+                "_ttc_by_path": lambda: custom_observations._ttc_by_path(obs),
+                "_ego_ttc_calc": lambda: custom_observations._ego_ttc_calc(
+                    ego_lane_index, ttc_by_p, lane_dist_by_p
+                ),
+            }
+            for key, fn in timings.items():
+                results[key][num_lanes][num_neighbours] = _time_per_call_us(fn, repeat)
+
+    return results
+
+
+def main(args):
+    results = benchmark(
+        args.lanes,
+        args.neighbours,
+        args.path_len,
+        args.repeat,
+        args.seed,
+        args.check_allocations,
+    )
+
+    # one scaling curve per lane count, us per call over the neighbour count
+    for key, by_lanes in results.items():
+        print(f"\n{key} (us per call)")
+        print(f"{'lanes':>5} " + " ".join(f"{n:>9}" for n in args.neighbours))
+        for num_lanes, by_neighbours in by_lanes.items():
+            print(
+                f"{num_lanes:>5} "
+                + " ".join(f"{by_neighbours[n]:>9.1f}" for n in args.neighbours)
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "config": {
+                        "lanes": args.lanes,
+                        "neighbours": args.neighbours,
+                        "path_len": args.path_len,
+                        "seed": args.seed,
+                    },
+                    "us_per_call": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"Wrote results to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("microbenchmark")
+    parser.add_argument(
+        "--lanes",
+        type=int,
+        nargs="+",
+        default=[1, 2, 3, 4, 5],
+        help="Lane counts of the generated roads",
+    )
+    parser.add_argument(
+        "--neighbours",
+        type=int,
+        nargs="+",
+        default=[0, 10, 50, 100, 200],
+        help="Neighbour vehicle counts of the generated observations",
+    )
+    parser.add_argument(
+        "--path_len", type=int, default=50, help="Waypoints per waypoint path"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Timing runs, the fastest is reported"
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the fixtures")
+    parser.add_argument(
+        "--check_allocations",
+        action="store_true",
+        help="Fail if a step of the preallocated adapter leaves new numpy arrays, "
+        "its timings then include tracemalloc",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Also write the results as JSON"
+    )
+    args = parser.parse_args()
+    main(args)
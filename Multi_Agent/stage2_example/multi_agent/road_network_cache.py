@@ -0,0 +1,210 @@
+# this file is for compiling map.net.xml files to numpy arrays loaded with mmap
+import os
+import shutil
+import hashlib
+import argparse
+import tempfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("ROAD_NETWORK_CACHE_DIR", "~/.cache/road_networks")
+).expanduser()
+
+# lane width sumo uses when the net does not set one
+_DEFAULT_LANE_WIDTH = 3.2
+
+# bump when the arrays below change, so stale caches are not loaded
+_FORMAT_VERSION = 1
+
+ARRAYS = [
+    # one entry per edge
+    "edge_ids",
+    "edge_is_internal",
+    # one entry per lane, lanes of an edge are consecutive and ordered by index
+    "lane_ids",
+    "lane_edge",
+    "lane_index",
+    "lane_width",
+    "lane_speed",
+    "lane_length",
+    # lane i is the polyline lane_points[lane_shape_offsets[i] : [i + 1]]
+    "lane_shape_offsets",
+    "lane_points",
+    # one entry per connection, lane indices into the arrays above, via is -1
+    # for connections without an internal lane
+    "connection_from_lane",
+    "connection_to_lane",
+    "connection_via_lane",
+]
+
+
+def net_file_hash(net_file):
+    with open(net_file, "rb") as f:
+        digest = hashlib.sha1(f.read())
+    digest.update(str(_FORMAT_VERSION).encode())
+    return digest.hexdigest()
+
+
+def compile_road_network(net_file):
+    """Parses a sumo net file into the flat arrays listed in ARRAYS."""
+    root = ET.parse(str(net_file)).getroot()
+
+    edge_ids = []
+    edge_is_internal = []
+    lanes = []
+    for edge_idx, edge in enumerate(root.iter("edge")):
+        edge_ids.append(edge.get("id"))
+        edge_is_internal.append(edge.get("function") == "internal")
+        edge_lanes = sorted(edge.iter("lane"), key=lambda lane: int(lane.get("index")))
+        lanes.extend((edge_idx, lane) for lane in edge_lanes)
+
+    lane_ids = [lane.get("id") for _, lane in lanes]
+    lane_shapes = [
+        [[float(v) for v in xy.split(",")[:2]] for xy in lane.get("shape").split()]
+        for _, lane in lanes
+    ]
+    lane_shape_offsets = np.zeros(len(lanes) + 1, dtype=np.int64)
+    np.cumsum([len(shape) for shape in lane_shapes], out=lane_shape_offsets[1:])
+
+    lane_idx_by_id = {lane_id: i for i, lane_id in enumerate(lane_ids)}
+    first_lane_by_edge = {}
+    for i, (edge_idx, _) in enumerate(lanes):
+        first_lane_by_edge.setdefault(edge_ids[edge_idx], i)
+
+    connections = []
+    for connection in root.iter("connection"):
+        from_edge, to_edge = connection.get("from"), connection.get("to")
+        if from_edge not in first_lane_by_edge or to_edge not in first_lane_by_edge:
+            continue
+        via = connection.get("via")
+        connections.append(
+            (
+                first_lane_by_edge[from_edge] + int(connection.get("fromLane")),
+                first_lane_by_edge[to_edge] + int(connection.get("toLane")),
+                lane_idx_by_id.get(via, -1) if via else -1,
+            )
+        )
+    connections = np.array(connections, dtype=np.int64).reshape(-1, 3)
+
+    return {
+        "edge_ids": np.array(edge_ids, dtype=str),
+        "edge_is_internal": np.array(edge_is_internal, dtype=bool),
+        "lane_ids": np.array(lane_ids, dtype=str),
+        "lane_edge": np.array([edge_idx for edge_idx, _ in lanes], dtype=np.int32),
+        "lane_index": np.array(
+            [int(lane.get("index")) for _, lane in lanes], dtype=np.int32
+        ),
+        "lane_width": np.array(
+            [float(lane.get("width", _DEFAULT_LANE_WIDTH)) for _, lane in lanes],
+            dtype=np.float32,
+        ),
+        "lane_speed": np.array(
+            [float(lane.get("speed")) for _, lane in lanes], dtype=np.float32
+        ),
+        "lane_length": np.array(
+            [float(lane.get("length")) for _, lane in lanes], dtype=np.float32
+        ),
+        "lane_shape_offsets": lane_shape_offsets,
+        "lane_points": np.array(
+            [point for shape in lane_shapes for point in shape], dtype=np.float64
+        ).reshape(-1, 2),
+        "connection_from_lane": connections[:, 0],
+        "connection_to_lane": connections[:, 1],
+        "connection_via_lane": connections[:, 2],
+    }
+
+
+class CompiledRoadNetwork:
+    """The arrays of a compiled net file as attributes, memory-mapped
+    read-only, plus lookups that sumolib's road network would need the XML
+    for.
+    """
+
+    def __init__(self, arrays):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self._lane_idx_by_id = None
+
+    def lane_shape(self, lane_idx):
+        start, end = self.lane_shape_offsets[lane_idx : lane_idx + 2]
+        return self.lane_points[start:end]
+
+    def lane_idx(self, lane_id):
+        if self._lane_idx_by_id is None:
+            self._lane_idx_by_id = {
+                lane_id: i for i, lane_id in enumerate(self.lane_ids.tolist())
+            }
+        return self._lane_idx_by_id[lane_id]
+
+    def outgoing_lanes(self, lane_idx):
+        return self.connection_to_lane[self.connection_from_lane == lane_idx]
+
+    def incoming_lanes(self, lane_idx):
+        return self.connection_from_lane[self.connection_to_lane == lane_idx]
+
+
+def compiled_road_network_dir(net_file, cache_dir=DEFAULT_CACHE_DIR):
+    return Path(cache_dir) / net_file_hash(net_file)
+
+
+def precompile_road_network(net_file, cache_dir=DEFAULT_CACHE_DIR):
+    """Compiles `net_file` into `cache_dir/<content hash>/` unless it is
+    already there, and returns that directory.
+    """
+    path = compiled_road_network_dir(net_file, cache_dir)
+    if path.exists():
+        return path
+
+    arrays = compile_road_network(net_file)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary directory and rename it, so concurrent workers
+    # never load a half written cache
+    tmp_path = Path(tempfile.mkdtemp(dir=path.parent))
+    try:
+        for name in ARRAYS:
+            np.save(tmp_path / f"{name}.npy", arrays[name])
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not path.exists():
+            raise
+
+    return path
+
+
+def load_road_network(net_file, cache_dir=DEFAULT_CACHE_DIR):
+    """Returns the CompiledRoadNetwork of `net_file`, compiled on first use.
+    A changed net file has a new hash, so it is compiled again.
+    """
+    path = precompile_road_network(net_file, cache_dir)
+    return CompiledRoadNetwork(
+        {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+    )
+
+
+def main(args):
+    for scenario in args.scenarios:
+        for net_file in sorted(Path(scenario).glob("**/map.net.xml")):
+            path = precompile_road_network(net_file, args.cache_dir)
+            print(f"{net_file} -> {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("road-network-cache")
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        default=[str(Path(__file__).parent / "f1_public")],
+        help="Scenario directories, every map.net.xml below them is compiled",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=str(DEFAULT_CACHE_DIR),
+        help="Directory of the compiled nets, also set by ROAD_NETWORK_CACHE_DIR",
+    )
+    args = parser.parse_args()
+    main(args)
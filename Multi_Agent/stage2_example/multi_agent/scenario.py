@@ -1,9 +1,9 @@
 # this file is for generating social agents and their missions
 
 import os
+import argparse
 from pathlib import Path
 
-from smarts.sstudio import gen_traffic, gen_missions, gen_social_agent_missions
 from smarts.sstudio.types import (
     Traffic,
     Flow,
@@ -14,6 +14,14 @@ from smarts.sstudio.types import (
     Distribution,
 )
 
+from artifact_cache import ArtifactCache, DEFAULT_CACHE_DIR
+from scenario_build import (
+    build,
+    traffic_task,
+    missions_task,
+    social_agent_missions_task,
+)
+
 # Scenario Paths
 scenario_dir = (Path(__file__).parent / "f1_public").resolve()
 scenario_names = ["shanghai", "silverstone", "monte", "interlagos"]
@@ -47,10 +55,11 @@ social_agent3 = SocialAgentActor(
 # here define social agent type and numbers
 social_agents = [social_agent2, social_agent3, social_agent1]
 
-# generate social agent missisons and store social agents' information under social_agents/
-for scenario, starting_edge in zip(scenario_paths, starting_edges):
-    for i, social_agent in enumerate(social_agents):
-        gen_social_agent_missions(
+
+def social_agent_mission_tasks():
+    # generate social agent missisons and store social agents' information under social_agents/
+    return [
+        social_agent_missions_task(
             scenario,
             social_agent_actor=social_agent,
             name=f"s-agent-{social_agent.name}",
@@ -59,30 +68,31 @@ for scenario, starting_edge in zip(scenario_paths, starting_edges):
                 EndlessMission(begin=(starting_edge, i + 1, 0),),
                 # Mission(Route(begin=("edge-east", 1, 0), end=("edge-east", 1, -5))),
             ],
-            overwrite=True,
         )
-
-print("generate social agent missions finished")
+        for scenario, starting_edge in zip(scenario_paths, starting_edges)
+        for i, social_agent in enumerate(social_agents)
+    ]
 
 
 #########################################
 # generate agent missions
 #########################################
 
-# generate agent Missions so agents will born in the same position after env reset()
-# Otherwise, no defined agent mission will lead to agent born in different place after env reset()
-for scenario, starting_edge in zip(scenario_paths, starting_edges):
-    gen_missions(
-        scenario=scenario,
-        missions=[
-            # edge_id, lane_index, offset
-            EndlessMission(begin=(starting_edge, 0, 0),),
-            # Mission(Route(begin=("edge-east", 0, 0), end=("edge-east", 0, -5))),
-        ],
-        overwrite=True,
-    )
 
-print("generate ego agent missions finished")
+def agent_mission_tasks():
+    # generate agent Missions so agents will born in the same position after env reset()
+    # Otherwise, no defined agent mission will lead to agent born in different place after env reset()
+    return [
+        missions_task(
+            scenario,
+            missions=[
+                # edge_id, lane_index, offset
+                EndlessMission(begin=(starting_edge, 0, 0),),
+                # Mission(Route(begin=("edge-east", 0, 0), end=("edge-east", 0, -5))),
+            ],
+        )
+        for scenario, starting_edge in zip(scenario_paths, starting_edges)
+    ]
 
 
 #########################################
@@ -94,31 +104,68 @@ seed = 45
 
 traffic_actor = TrafficActor(name="car", speed=Distribution(sigma=0.1, mean=0.3),)
 
-for scenario_path, sv_num in zip(scenario_paths, sv_nums):
-    traffic = Traffic(
-        flows=[
-            Flow(
-                route=RandomRoute(),
-                begin=0,
-                end=1
-                * 60
-                * 60,  # make sure end time is larger than the time of one episode
-                rate=60,
-                actors={traffic_actor: 1},
+
+def social_vehicle_tasks():
+    tasks = []
+    for scenario_path, sv_num in zip(scenario_paths, sv_nums):
+        traffic = Traffic(
+            flows=[
+                Flow(
+                    route=RandomRoute(),
+                    begin=0,
+                    end=1
+                    * 60
+                    * 60,  # make sure end time is larger than the time of one episode
+                    rate=60,
+                    actors={traffic_actor: 1},
+                )
+                for i in range(sv_num)
+            ]
+        )
+
+        print(f"generate flow with {sv_num} social vehicles in {scenario_path.name} ")
+
+        tasks.append(
+            traffic_task(
+                scenario_path,
+                traffic,
+                name="all",
+                output_dir=scenario_path,
+                seed=seed,
             )
-            for i in range(sv_num)
-        ]
-    )
+        )
+    return tasks
 
-    print(f"generate flow with {sv_num} social vehicles in {scenario_path.name} ")
 
-    gen_traffic(
-        scenario_path,
-        traffic,
-        name="all",
-        output_dir=scenario_path,
-        seed=seed,
-        overwrite=True,
-    )
+def main(args):
+    cache = None if args.no_cache else ArtifactCache(args.cache_dir)
+    # every map and artifact is generated in its own process, artifacts
+    # whose map, spec and seed did not change are skipped
+    tasks = social_agent_mission_tasks() + agent_mission_tasks()
+    tasks += social_vehicle_tasks()
+    build(tasks, jobs=args.jobs, force=args.force, cache=cache)
+
+    print("generate social agent missions, ego agent missions and flows finished")
 
-print("generate social vehicle flows finished")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("scenario")
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Processes, one per core by default"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Generate every artifact, even the up to date ones",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help="Cache of generated artifacts shared by all builds on this machine",
+    )
+    parser.add_argument(
+        "--no_cache", action="store_true", help="Do not use the artifact cache"
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,174 @@
+# this file is for timing the stages of the agent adapter chain, opt-in: agents
+# that are not wrapped with profiled_agent(..) run without any overhead
+import time
+import dataclasses
+from collections import defaultdict
+
+from smarts.env.agent import AgentPolicy
+
+from time_histogram import TimeHistogram
+
+STAGES = [
+    "observation_adapter",
+    "preprocessor",
+    "policy",
+    "action_adapter",
+    "reward_adapter",
+]
+
+
+class StageProfiler:
+    """Time histograms keyed by (agent id, stage)."""
+
+    def __init__(self):
+        self.histograms = defaultdict(TimeHistogram)
+        # agent whose policy runs, the preprocessor is called inside it
+        self.current_agent = None
+
+    def record(self, agent_id, stage, seconds):
+        self.histograms[agent_id, stage].add(seconds)
+
+    def reset(self):
+        self.histograms.clear()
+
+    def custom_metrics(self):
+        """Mean, p50 and p99 in milliseconds per agent and stage, named like
+        `Agent-007_observation_adapter_p99_ms`.
+        """
+        metrics = {}
+        for (agent_id, stage), histogram in self.histograms.items():
+            if not histogram.count:
+                continue
+            name = f"{agent_id}_{stage}"
+            metrics[f"{name}_mean_ms"] = 1000 * histogram.total / histogram.count
+            metrics[f"{name}_p50_ms"] = 1000 * histogram.percentile(0.5)
+            metrics[f"{name}_p99_ms"] = 1000 * histogram.percentile(0.99)
+        return metrics
+
+    def summary_table(self):
+        header = ["agent", "stage", "calls", "mean ms", "p50 ms", "p90 ms"]
+        header += ["p99 ms", "max ms", "total s"]
+        rows = [header]
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        for agent_id, stage in sorted(
+            self.histograms, key=lambda key: (str(key[0]), order.get(key[1], 99))
+        ):
+            histogram = self.histograms[agent_id, stage]
+            if not histogram.count:
+                continue
+            rows.append(
+                [
+                    str(agent_id),
+                    stage,
+                    str(histogram.count),
+                    f"{1000 * histogram.total / histogram.count:.3f}",
+                    f"{1000 * histogram.percentile(0.5):.3f}",
+                    f"{1000 * histogram.percentile(0.9):.3f}",
+                    f"{1000 * histogram.percentile(0.99):.3f}",
+                    f"{1000 * histogram.max:.3f}",
+                    f"{histogram.total:.2f}",
+                ]
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return "\n".join(
+            "  ".join(cell.rjust(width) for cell, width in zip(row, widths))
+            for row in rows
+        )
+
+
+# one per process, the wrappers below are pickled into the rollout workers
+# and record into the profiler of the worker they run in
+profiler = StageProfiler()
+
+
+class _Timed:
+    def __init__(self, fn, agent_id, stage):
+        self.fn = fn
+        self.agent_id = agent_id
+        self.stage = stage
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            profiler.record(self.agent_id, self.stage, time.perf_counter() - start)
+
+
+class _TimedPreprocessor(_Timed):
+    # shared by all agents of the policy, attributed to the acting one
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            profiler.record(
+                profiler.current_agent, self.stage, time.perf_counter() - start
+            )
+
+
+class ProfiledPolicy(AgentPolicy):
+    """Times `act` and `act_batch` of `policy` as the "policy" stage of
+    `agent_id`, and its RLlib preprocessor, if any, as "preprocessor".
+    """
+
+    def __init__(self, policy, agent_id):
+        self.policy = policy
+        self.agent_id = agent_id
+
+    def setup(self):
+        self.policy.setup()
+
+    def teardown(self):
+        self.policy.teardown()
+
+    def _time_preprocessor(self):
+        prep = getattr(self.policy, "_prep", None)
+        if prep is not None and not isinstance(prep.transform, _TimedPreprocessor):
+            prep.transform = _TimedPreprocessor(prep.transform, None, "preprocessor")
+
+    def act(self, obs):
+        return self._timed(self.policy.act, obs)
+
+    def act_batch(self, obs_dict):
+        return self._timed(self.policy.act_batch, obs_dict)
+
+    def _timed(self, act, obs):
+        profiler.current_agent = self.agent_id
+        start = time.perf_counter()
+        try:
+            return act(obs)
+        finally:
+            profiler.record(self.agent_id, "policy", time.perf_counter() - start)
+            # the preprocessor exists once the policy is set up
+            self._time_preprocessor()
+
+
+def profiled_agent(agent, agent_id):
+    """Copy of `agent` whose adapters and policy record their wall times
+    under `agent_id`.
+    """
+    return dataclasses.replace(
+        agent,
+        policy=ProfiledPolicy(agent.policy, agent_id),
+        observation_adapter=_Timed(
+            agent.observation_adapter, agent_id, "observation_adapter"
+        ),
+        action_adapter=_Timed(agent.action_adapter, agent_id, "action_adapter"),
+        reward_adapter=_Timed(agent.reward_adapter, agent_id, "reward_adapter"),
+    )
+
+
+def profiled_callbacks(callbacks):
+    """RLlib `callbacks` that also report the stage times of every episode
+    as custom metrics, with the other callbacks' metrics.
+    """
+    on_episode_end = callbacks.get("on_episode_end")
+
+    def profiled_on_episode_end(info):
+        if on_episode_end is not None:
+            on_episode_end(info)
+        info["episode"].custom_metrics.update(profiler.custom_metrics())
+        profiler.reset()
+
+    return dict(callbacks, on_episode_end=profiled_on_episode_end)
@@ -0,0 +1,292 @@
+# this file is for generating many traffic variants of the maps for curriculum training
+import os
+import json
+import random
+import argparse
+import itertools
+from pathlib import Path
+
+from smarts.sstudio.types import (
+    Traffic,
+    Flow,
+    SocialAgentActor,
+    EndlessMission,
+    RandomRoute,
+    TrafficActor,
+    Distribution,
+)
+
+from artifact_cache import ArtifactCache, DEFAULT_CACHE_DIR
+from road_network_cache import load_road_network
+from scenario_build import (
+    build,
+    traffic_task,
+    missions_task,
+    social_agent_missions_task,
+)
+
+MANIFEST_FILE = "manifest.json"
+
+# every combination of the lists below becomes one variant, `maps` lists the
+# starting edges of every map, null spawns the agents at random places and
+# can not be combined with social agents. A json file with (some of) these
+# keys passed with --spec replaces them
+DEFAULT_SWEEP = {
+    "maps": {
+        "f1_public/shanghai": ["-156328679"],
+        "f1_public/silverstone": ["gneE9"],
+        "f1_public/monte": ["179968249"],
+        "f1_public/interlagos": ["138566998"],
+        "dataset_public/1lane": [None],
+        "dataset_public/1lane_sharp": [None],
+        "dataset_public/2lane_bwd": [None],
+        "dataset_public/2lane_sharp": [None],
+        "dataset_public/3lane": [None],
+        "dataset_public/3lane_bwd_b": [None],
+        "dataset_public/3lane_sharp": [None],
+        "dataset_public/3lane_sharp_bwd_b": [None],
+        "dataset_public/3lane_sharp_bwd_c": [None],
+    },
+    "sv_num": [20, 40, 60],
+    "rate": [30, 60],
+    "speed_mean": [0.3, 0.6],
+    "speed_sigma": [0.1, 0.2],
+    # agent locators of the social agents, see agent_prefabs.py
+    "social_agents": [[]],
+    "seed": [45],
+}
+
+# the generated files live in the variant directory, the map files are linked
+_MAP_FILES = ["map.net.xml", "map.glb", "map.egg"]
+
+
+def variants(sweep):
+    """Parameters of every variant of `sweep`, one dict each."""
+    params = [
+        "sv_num",
+        "rate",
+        "speed_mean",
+        "speed_sigma",
+        "social_agents",
+        "seed",
+    ]
+    for map_name, starting_edges in sweep["maps"].items():
+        for starting_edge in starting_edges:
+            for values in itertools.product(*[sweep[param] for param in params]):
+                variant = dict(zip(params, values))
+                if variant["social_agents"] and starting_edge is None:
+                    continue
+                variant.update(map=map_name, starting_edge=starting_edge)
+                variant["name"] = variant_name(variant, sweep)
+                yield variant
+
+
+def variant_name(variant, sweep):
+    # indices instead of edge ids and locators, which are long and not
+    # always valid in a file name
+    map_name = variant["map"].replace("/", "-")
+    edge = sweep["maps"][variant["map"]].index(variant["starting_edge"])
+    agents = sweep["social_agents"].index(variant["social_agents"])
+    return (
+        f"{map_name}_sv{variant['sv_num']}_r{variant['rate']}"
+        f"_m{variant['speed_mean']}_s{variant['speed_sigma']}"
+        f"_e{edge}_a{agents}_seed{variant['seed']}"
+    )
+
+
+def _num_lanes(net_file, edge_id):
+    net = load_road_network(net_file)
+    edge_idx = net.edge_ids.tolist().index(edge_id)
+    return int((net.lane_edge == edge_idx).sum())
+
+
+def _link_map(map_dir, variant_dir):
+    variant_dir.mkdir(parents=True, exist_ok=True)
+    for name in _MAP_FILES:
+        src, dst = map_dir / name, variant_dir / name
+        if src.exists() and not dst.exists():
+            os.symlink(src.resolve(), dst)
+
+
+def variant_tasks(variant, variant_dir):
+    traffic_actor = TrafficActor(
+        name="car",
+        speed=Distribution(sigma=variant["speed_sigma"], mean=variant["speed_mean"]),
+    )
+    traffic = Traffic(
+        flows=[
+            Flow(
+                # the default id is a random uuid, which ends up in the flow ids
+                # of the route file
+                route=RandomRoute(id=f"random-route-{variant['name']}-{i}"),
+                begin=0,
+                end=1
+                * 60
+                * 60,  # make sure end time is larger than the time of one episode
+                rate=variant["rate"],
+                actors={traffic_actor: 1},
+            )
+            for i in range(variant["sv_num"])
+        ]
+    )
+    tasks = [
+        traffic_task(
+            variant_dir,
+            traffic,
+            name="all",
+            output_dir=variant_dir,
+            seed=variant["seed"],
+        )
+    ]
+
+    starting_edge = variant["starting_edge"]
+    if starting_edge is None:
+        return tasks
+
+    # like scenario.py, the agent starts on lane 0 and the social agents on
+    # the lanes left of it
+    tasks.append(
+        missions_task(
+            variant_dir,
+            missions=[EndlessMission(begin=(starting_edge, 0, 0),)],
+            seed=variant["seed"],
+        )
+    )
+    for i, agent_locator in enumerate(variant["social_agents"]):
+        social_agent = SocialAgentActor(
+            name=f"zoo-car{i + 1}", agent_locator=agent_locator
+        )
+        tasks.append(
+            social_agent_missions_task(
+                variant_dir,
+                missions=[EndlessMission(begin=(starting_edge, i + 1, 0),)],
+                social_agent_actor=social_agent,
+                name=f"s-agent-{social_agent.name}",
+                seed=variant["seed"],
+            )
+        )
+    return tasks
+
+
+def generate(sweep, map_root, output_dir, jobs=None, force=False, cache=None):
+    """Generates every variant of `sweep` into `output_dir/<name>/`, with
+    the maps under `map_root`, in parallel, and writes the manifest.
+    """
+    map_root, output_dir = Path(map_root), Path(output_dir)
+    entries = []
+    tasks = []
+    lanes = {}
+    for variant in variants(sweep):
+        map_dir = map_root / variant["map"]
+        if not (map_dir / "map.net.xml").exists():
+            raise FileNotFoundError(f"no map.net.xml in {map_dir}")
+
+        edge = variant["starting_edge"]
+        if variant["social_agents"]:
+            if (map_dir, edge) not in lanes:
+                lanes[map_dir, edge] = _num_lanes(map_dir / "map.net.xml", edge)
+            if len(variant["social_agents"]) >= lanes[map_dir, edge]:
+                print(f"skip {variant['name']}, {edge} has too few lanes")
+                continue
+
+        variant_dir = output_dir / variant["name"]
+        _link_map(map_dir, variant_dir)
+        tasks += variant_tasks(variant, variant_dir)
+        entries.append(dict(variant, path=variant["name"]))
+
+    print(f"{len(entries)} variants, {len(tasks)} artifacts")
+    build(tasks, jobs=jobs, force=force, cache=cache)
+    write_manifest(output_dir, entries)
+    return entries
+
+
+def write_manifest(output_dir, entries):
+    path = Path(output_dir) / MANIFEST_FILE
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"variants": entries}, f, indent=2)
+    tmp_path.replace(path)
+
+
+def load_manifest(path):
+    """Variants listed in the manifest at `path` (a file or the directory
+    holding it), with `path` resolved to the variant directory.
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / MANIFEST_FILE
+    with open(path) as f:
+        entries = json.load(f)["variants"]
+    for entry in entries:
+        entry["path"] = str((path.parent / entry["path"]).resolve())
+    return entries
+
+
+def select_variants(entries, num=None, seed=None, **where):
+    """Variants whose parameters equal `where`, e.g. map="f1_public/monte",
+    and `num` of them drawn at random if given.
+    """
+    entries = [
+        entry
+        for entry in entries
+        if all(entry[param] == value for param, value in where.items())
+    ]
+    if num is not None and num < len(entries):
+        entries = random.Random(seed).sample(entries, num)
+    return entries
+
+
+def main(args):
+    sweep = dict(DEFAULT_SWEEP)
+    if args.spec:
+        with open(args.spec) as f:
+            sweep.update(json.load(f))
+
+    cache = None if args.no_cache else ArtifactCache(args.cache_dir)
+    generate(
+        sweep,
+        args.map_root,
+        args.output_dir,
+        jobs=args.jobs,
+        force=args.force,
+        cache=cache,
+    )
+    print(f"wrote {Path(args.output_dir) / MANIFEST_FILE}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("sweep")
+    parser.add_argument(
+        "--spec", type=str, default=None, help="Json file with the parameter grids"
+    )
+    parser.add_argument(
+        "--map_root",
+        type=str,
+        default=str(Path(__file__).parent),
+        help="Directory holding f1_public and dataset_public",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=str(Path(__file__).parent / "sweep"),
+        help="Directory of the variants and the manifest",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Processes, one per core by default"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Generate every artifact, even the up to date ones",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help="Cache of generated artifacts shared by all builds on this machine",
+    )
+    parser.add_argument(
+        "--no_cache", action="store_true", help="Do not use the artifact cache"
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,89 @@
+# this file is for exporting a trained model to numpy weights for numpy_policy.py
+import os
+import re
+import pickle
+import argparse
+
+import numpy as np
+
+# the policy network of FullyConnectedNetwork, the value branch is named
+# fc_value_<i>/value_out and optimizer slots have a suffix, so neither match
+_DENSE_VARIABLE = re.compile(r"/(fc_(\d+)|fc_out)/(kernel|bias)(:0)?$")
+
+
+def weights_from_checkpoint(path, policy_name):
+    # checkpoint generated during training, like checkpoint_66/checkpoint-66
+    objs = pickle.load(open(path, "rb"))
+    objs = pickle.loads(objs["worker"])
+    return objs["state"][policy_name]
+
+
+def weights_from_saved_model(path):
+    # model exported at end, like model/
+    from ray.rllib.utils import try_import_tf
+
+    tf = try_import_tf()
+    with tf.Session(graph=tf.Graph()) as sess:
+        tf.saved_model.load(sess, export_dir=path, tags=["serve"])
+        variables = tf.global_variables()
+        return dict(zip([v.name for v in variables], sess.run(variables)))
+
+
+def dense_layers(weights, policy_name):
+    layers = {}
+    for name, value in weights.items():
+        match = _DENSE_VARIABLE.search(name)
+        if not match or not name.startswith(policy_name + "/"):
+            continue
+        # fc_out is the last layer
+        index = int(match.group(2)) if match.group(2) else float("inf")
+        layers.setdefault(index, {})[match.group(3)] = np.asarray(
+            value, dtype=np.float32
+        )
+
+    if not layers:
+        raise ValueError(f"No dense layers of {policy_name} found")
+
+    return [(layers[i]["kernel"], layers[i]["bias"]) for i in sorted(layers)]
+
+
+def main(args):
+    if os.path.isdir(args.model_path):
+        weights = weights_from_saved_model(args.model_path)
+    else:
+        weights = weights_from_checkpoint(args.model_path, args.policy_name)
+
+    layers = dense_layers(weights, args.policy_name)
+
+    arrays = {"num_layers": len(layers), "activation": args.activation}
+    for i, (kernel, bias) in enumerate(layers):
+        arrays[f"kernel_{i}"] = kernel
+        arrays[f"bias_{i}"] = bias
+    np.savez(args.output_path, **arrays)
+
+    sizes = [layers[0][0].shape[0]] + [kernel.shape[1] for kernel, _ in layers]
+    print(f"Wrote layers {sizes} to {args.output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("export-numpy-model")
+    parser.add_argument(
+        "model_path",
+        type=str,
+        help="Exported model directory (model/) or training checkpoint (checkpoint-N)",
+    )
+    parser.add_argument(
+        "--output_path", type=str, default="model.npz", help="Path of the .npz file"
+    )
+    parser.add_argument(
+        "--policy_name", type=str, default="default_policy", help="Policy to export"
+    )
+    parser.add_argument(
+        "--activation",
+        type=str,
+        default="tanh",
+        choices=["tanh", "relu", "linear"],
+        help="fcnet_activation the model was trained with",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,73 @@
+# this file is for measuring how long importing the evaluation modules takes
+import sys
+import time
+import argparse
+import subprocess
+from pathlib import Path
+from collections import defaultdict
+
+
+def _run_python(code, cwd):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    wall_time = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"`{code}` failed:\n{proc.stderr}")
+
+    return wall_time, proc.stderr
+
+
+def _import_time_by_package(importtime_log):
+    # lines look like "import time:  self [us] | cumulative | imported package",
+    # nested imports are indented, so only the outermost ones are summed up
+    time_by_package = defaultdict(float)
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        _, cumulative_us, name = line[len("import time:") :].split("|")
+        if name[1:2] == " ":
+            continue
+
+        time_by_package[name.strip().split(".")[0]] += int(cumulative_us) / 1e6
+
+    return time_by_package
+
+
+def main(args):
+    cwd = Path(__file__).parent
+    baseline, baseline_log = _run_python("pass", cwd)
+    startup_packages = set(_import_time_by_package(baseline_log))
+    print(f"python startup: {baseline:.3f}s")
+
+    for module in args.modules:
+        wall_time, log = _run_python(f"import {module}", cwd)
+        time_by_package = _import_time_by_package(log)
+
+        print(f"\nimport {module}: {wall_time - baseline:.3f}s")
+        for package in startup_packages:
+            time_by_package.pop(package, None)
+        top = sorted(time_by_package.items(), key=lambda item: -item[1])
+        for package, seconds in top[: args.top]:
+            print(f"    {package:<30} {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("import-time-report")
+    parser.add_argument(
+        "modules",
+        nargs="*",
+        default=["agent", "custom_observations", "numpy_policy"],
+        help="Modules to import, relative to this directory",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of slowest packages to show"
+    )
+    args = parser.parse_args()
+    main(args)
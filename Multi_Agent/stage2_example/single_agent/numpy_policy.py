@@ -0,0 +1,79 @@
+# this file is for evaluation without tensorflow
+import gym
+import numpy as np
+
+from smarts.env.agent import AgentPolicy
+
+_ACTIVATIONS = {
+    "tanh": np.tanh,
+    "relu": lambda x: np.maximum(x, 0),
+    "linear": lambda x: x,
+}
+
+
+#########################################
+# restore weights exported by export_numpy_model.py, like model.npz
+#########################################
+class NumpyMLPPolicy(AgentPolicy):
+    """Deterministic action of an exported FullyConnectedNetwork policy,
+    computed with numpy matmuls instead of a tensorflow session.
+    """
+
+    def __init__(self, path_to_weights, observation_space, action_space):
+        self._path_to_weights = path_to_weights
+        self._observation_space = observation_space
+        self._layers = None
+
+        if isinstance(action_space, gym.spaces.Box):
+            self.is_continuous = True
+        elif isinstance(action_space, gym.spaces.Discrete):
+            self.is_continuous = False
+        else:
+            raise TypeError("Unsupport action space")
+
+    def setup(self):
+        if self._layers:
+            return
+
+        weights = np.load(self._path_to_weights)
+        num_layers = int(weights["num_layers"])
+        self._layers = [
+            (weights[f"kernel_{i}"], weights[f"bias_{i}"]) for i in range(num_layers)
+        ]
+        self._activation = _ACTIVATIONS[str(weights["activation"])]
+
+    def act(self, obs):
+        return self._forward(self._flatten(obs)[np.newaxis])[0]
+
+    def act_batch(self, obs_dict):
+        # one forward pass for the observations of all agents sharing this policy
+        agent_ids = list(obs_dict)
+        obs_batch = np.stack(
+            [self._flatten(obs_dict[agent_id]) for agent_id in agent_ids]
+        )
+        return dict(zip(agent_ids, self._forward(obs_batch)))
+
+    def _flatten(self, obs):
+        # same layout as RLlib's preprocessor, gym.spaces.Dict sorts its keys
+        if isinstance(self._observation_space, gym.spaces.Dict):
+            return np.concatenate(
+                [np.ravel(obs[key]) for key in self._observation_space.spaces]
+            ).astype(np.float32)
+        return np.asarray(obs, dtype=np.float32)
+
+    def _forward(self, obs_batch):
+        if self._layers is None:
+            self.setup()
+
+        x = obs_batch
+        for kernel, bias in self._layers[:-1]:
+            x = self._activation(x @ kernel + bias)
+        kernel, bias = self._layers[-1]
+        logits = x @ kernel + bias
+
+        if self.is_continuous:
+            # the model outputs mean and log std, the mean is the
+            # deterministic action, like "default_policy/split:0"
+            mean, _ = np.split(logits, 2, axis=1)
+            return mean
+        return np.argmax(logits, axis=1)
@@ -1,8 +1,12 @@
 # this file is for evaluation
 import os
+import argparse
 import gym
+import numpy as np
 from pathlib import Path
-from agent import agent
+from agent import flat_agent as agent, reset_observation_adapters
+from episode_recorder import EpisodeRecorder, new_episode_id
+from stage_profiler import ProfiledPolicy, profiled_agent, profiler
 from smarts.core import scenario
 
 
@@ -10,15 +14,23 @@ scenario_dir = (Path(__file__).parent / "f1_public").resolve()
 scenario_names = ["shanghai", "silverstone", "monte", "interlagos"]
 scenario_paths = [scenario_dir / name for name in scenario_names]
 
-AGENT_ID = "Agent-007"
 
 
-def main():
+def main(args):
+    # all agents share the same policy
+    agent_ids = [f"Agent-{i:03d}" for i in range(7, 7 + args.num_agents)]
+
+    agents = {agent_id: agent for agent_id in agent_ids}
+    policy = agent.policy
+    if args.profile_stages:
+        # the policy acts for all agents at once, its time is not per agent
+        agents = {agent_id: profiled_agent(agent, agent_id) for agent_id in agents}
+        policy = ProfiledPolicy(policy, "all")
 
     env = gym.make(
         "smarts.env:hiway-v0",
         scenarios=scenario_paths,
-        agents={AGENT_ID: agent},
+        agents=agents,
         # set headless to false if u want to use envision
         headless=True,
         visdom=False,
@@ -26,21 +38,62 @@ def main():
     )
 
     agent.reset()
+    recorder = EpisodeRecorder(args.record_dir) if args.record_dir else None
 
     while True:
+        reset_observation_adapters()
         observations = env.reset()
+        episode_id = new_episode_id()
         total_reward = 0.0
         dones = {"__all__": False}
 
         while not dones["__all__"]:
-            agent_obs = observations[AGENT_ID]
-            agent_action = agent.act(agent_obs)
-            observations, rewards, dones, _ = env.step({AGENT_ID: agent_action})
-            total_reward += rewards[AGENT_ID]
+            # act for all agents with one batched policy call
+            agent_actions = policy.act_batch(observations)
+            if recorder:
+                # the adapter reuses its buffers, copy before the next step
+                observations = {
+                    agent_id: np.copy(obs) for agent_id, obs in observations.items()
+                }
+            next_observations, rewards, dones, _ = env.step(agent_actions)
+            total_reward += sum(rewards.values())
+
+            if recorder:
+                for agent_id, action in agent_actions.items():
+                    recorder.record_step(
+                        episode_id,
+                        agent_id,
+                        observations[agent_id],
+                        action,
+                        rewards[agent_id],
+                        dones[agent_id],
+                    )
+            observations = next_observations
+
+        if recorder:
+            recorder.end_episode(episode_id)
         print("Accumulated reward:", total_reward)
+        if args.profile_stages:
+            print(profiler.summary_table())
 
     env.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser("evaluation")
+    parser.add_argument(
+        "--num_agents", type=int, default=1, help="Number of agents sharing the policy"
+    )
+    parser.add_argument(
+        "--record_dir",
+        type=str,
+        default=None,
+        help="Record the observations, actions, rewards and dones to this directory",
+    )
+    parser.add_argument(
+        "--profile_stages",
+        action="store_true",
+        help="Print the adapter and policy stage times after every episode",
+    )
+    args = parser.parse_args()
+    main(args)
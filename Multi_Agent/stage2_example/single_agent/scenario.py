@@ -1,8 +1,8 @@
 # this file is for generating social agents and their missions
 
+import argparse
 from pathlib import Path
 
-from smarts.sstudio import gen_traffic
 from smarts.sstudio.types import (
     Traffic,
     Flow,
@@ -11,6 +11,9 @@ from smarts.sstudio.types import (
     Distribution,
 )
 
+from artifact_cache import ArtifactCache, DEFAULT_CACHE_DIR
+from scenario_build import build, traffic_task
+
 scenario_dir = (Path(__file__).parent / "f1_public").resolve()
 scenario_names = ["shanghai", "silverstone", "monte", "interlagos"]
 scenario_paths = [scenario_dir / name for name in scenario_names]
@@ -22,29 +25,64 @@ seed = 45
 
 traffic_actor = TrafficActor(name="car", speed=Distribution(sigma=0.1, mean=0.3),)
 
-for scenario_path, sv_num in zip(scenario_paths, sv_nums):
-    traffic = Traffic(
-        flows=[
-            Flow(
-                route=RandomRoute(),
-                begin=0,
-                end=1
-                * 60
-                * 60,  # make sure end time is larger than the time of one episode
-                rate=60,
-                actors={traffic_actor: 1},
+
+def social_vehicle_tasks():
+    tasks = []
+    for scenario_path, sv_num in zip(scenario_paths, sv_nums):
+        traffic = Traffic(
+            flows=[
+                Flow(
+                    route=RandomRoute(),
+                    begin=0,
+                    end=1
+                    * 60
+                    * 60,  # make sure end time is larger than the time of one episode
+                    rate=60,
+                    actors={traffic_actor: 1},
+                )
+                for i in range(sv_num)
+            ]
+        )
+
+        print(f"generate flow with {sv_num} social vehicles in {scenario_path.name} ")
+
+        tasks.append(
+            traffic_task(
+                scenario_path,
+                traffic,
+                name="all",
+                output_dir=scenario_path,
+                seed=seed,
             )
-            for i in range(sv_num)
-        ]
-    )
+        )
+    return tasks
 
-    print(f"generate flow with {sv_num} social vehicles in {scenario_path.name} ")
 
-    gen_traffic(
-        scenario_path,
-        traffic,
-        name="all",
-        output_dir=scenario_path,
-        seed=seed,
-        overwrite=True,
+def main(args):
+    cache = None if args.no_cache else ArtifactCache(args.cache_dir)
+    # the maps are generated in parallel, maps whose flows and seed did not
+    # change are skipped
+    build(social_vehicle_tasks(), jobs=args.jobs, force=args.force, cache=cache)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("scenario")
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Processes, one per core by default"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Generate every artifact, even the up to date ones",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help="Cache of generated artifacts shared by all builds on this machine",
+    )
+    parser.add_argument(
+        "--no_cache", action="store_true", help="Do not use the artifact cache"
     )
+    args = parser.parse_args()
+    main(args)
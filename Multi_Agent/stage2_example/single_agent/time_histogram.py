@@ -0,0 +1,44 @@
+# this file is for log binned histograms of wall times
+import math
+
+# log spaced bins from 1us to 10s
+_MIN_EXP = -6
+_BINS_PER_DECADE = 10
+_NUM_BINS = 7 * _BINS_PER_DECADE
+
+
+class TimeHistogram:
+    """Wall times in fixed log spaced bins, ~26% apart, so percentiles are
+    within a bin of the exact ones whatever the number of samples.
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (_NUM_BINS + 2)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > 0:
+            # floor, not int(), so times below 1us land in the underflow bin
+            idx = math.floor((math.log10(seconds) - _MIN_EXP) * _BINS_PER_DECADE) + 1
+            idx = min(max(idx, 0), _NUM_BINS + 1)
+        else:
+            idx = 0
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Geometric centre of the bin holding the `p` quantile, in seconds."""
+        rank = p * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        return min(10 ** (_MIN_EXP + (idx - 0.5) / _BINS_PER_DECADE), self.max)
@@ -9,7 +9,10 @@ from ray.rllib.models.tf.fcnet_v2 import FullyConnectedNetwork
 from ray.rllib.utils import try_import_tf
 
 from smarts.core.agent_interface import AgentInterface, AgentType
-from smarts.env.custom_observations import lane_ttc_observation_adapter
+from smarts.env.custom_observations import (
+    lane_ttc_observation_adapter,
+    _ego_ttc_lane_dist,
+)
 from smarts.env.agent import Agent, AgentPolicy
 
 tf = try_import_tf()
@@ -25,10 +28,81 @@ ACTION_SPACE = gym.spaces.Box(
 OBSERVATION_SPACE = lane_ttc_observation_adapter.space
 
 
+def _flat_slices(dict_space):
+    # gym.spaces.Dict sorts its keys, which is also the order RLlib's dict
+    # preprocessor flattens them in
+    slices = {}
+    start = 0
+    for key, space in dict_space.spaces.items():
+        slices[key] = slice(start, start + space.shape[0])
+        start += space.shape[0]
+    return slices
+
+
+# The same observation already flattened to the model input, policies skip
+# the preprocessor for it.
+FLAT_OBSERVATION_SLICES = _flat_slices(OBSERVATION_SPACE)
+FLAT_OBSERVATION_SPACE = gym.spaces.Box(
+    low=np.concatenate([s.low for s in OBSERVATION_SPACE.spaces.values()]),
+    high=np.concatenate([s.high for s in OBSERVATION_SPACE.spaces.values()]),
+    dtype=np.float32,
+)
+
+
 def observation_adapter(env_observation):
     return lane_ttc_observation_adapter.transform(env_observation)
 
 
+class FlatObservationAdapter:
+    """The values of `observation_adapter`, written straight into a float32
+    buffer allocated the first time the ego vehicle is seen and returned, so
+    no arrays are allocated per step. The buffer is overwritten on the next
+    step of the same vehicle, so the observation has to be consumed right
+    away, like by ModelPolicy.act(..). Call `reset()` before `env.reset()`,
+    vehicle ids change every episode and their buffers are reused.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._free_buffers = []
+
+    def __call__(self, env_observation):
+        ego = env_observation.ego_vehicle_state
+        out = self._buffers.get(ego.id)
+        if out is None:
+            if self._free_buffers:
+                out = self._free_buffers.pop()
+            else:
+                out = np.empty(FLAT_OBSERVATION_SPACE.shape, dtype=np.float32)
+            self._buffers[ego.id] = out
+
+        # same as smarts.env.custom_observations.lane_ttc_observation_adapter
+        wps = [path[0] for path in env_observation.waypoint_paths]
+        closest_wp = min(wps, key=lambda wp: wp.dist_to(ego.position))
+        signed_dist_from_center = closest_wp.signed_lateral_error(ego.position)
+        ego_ttc, ego_lane_dist = _ego_ttc_lane_dist(
+            env_observation, closest_wp.lane_index
+        )
+
+        slices = FLAT_OBSERVATION_SLICES
+        out[slices["distance_from_center"]] = signed_dist_from_center / (
+            closest_wp.lane_width * 0.5
+        )
+        out[slices["angle_error"]] = closest_wp.relative_heading(ego.heading)
+        out[slices["speed"]] = ego.speed
+        out[slices["steering"]] = ego.steering
+        out[slices["ego_ttc"]] = ego_ttc
+        out[slices["ego_lane_dist"]] = ego_lane_dist
+        return out
+
+    def reset(self):
+        self._free_buffers.extend(self._buffers.values())
+        self._buffers.clear()
+
+
+flat_observation_adapter = FlatObservationAdapter()
+
+
 def reward_adapter(env_obs, env_reward):
     return env_reward
 
@@ -47,7 +121,10 @@ ModelCatalog.register_custom_model(TrainingModel.NAME, TrainingModel)
 
 class ModelPolicy(AgentPolicy):
     def __init__(self, path_to_model, observation_space):
-        self._prep = ModelCatalog.get_preprocessor_for_space(observation_space)
+        # flat observations are already the model input
+        self._prep = None
+        if not isinstance(observation_space, gym.spaces.Box):
+            self._prep = ModelCatalog.get_preprocessor_for_space(observation_space)
         self._path_to_model = path_to_model
 
     def setup(self):
@@ -55,18 +132,20 @@ class ModelPolicy(AgentPolicy):
         self._sess.__enter__()
         tf.saved_model.load(self._sess, export_dir=self._path_to_model, tags=["serve"])
 
+        graph = tf.get_default_graph()
+        # These tensor names were found by inspecting the trained model
+        self.output_node = graph.get_tensor_by_name("default_policy/add:0")
+        self.input_node = graph.get_tensor_by_name("default_policy/observation:0")
+
     def teardown(self):
         # TODO: figure out the exact params to pass to this __exit__ call
         # self._sess.__exit__()
         pass
 
     def act(self, obs):
-        obs = self._prep.transform(obs)
-        graph = tf.get_default_graph()
-        # These tensor names were found by inspecting the trained model
-        output_node = graph.get_tensor_by_name("default_policy/add:0")
-        input_node = graph.get_tensor_by_name("default_policy/observation:0")
-        res = self._sess.run(output_node, feed_dict={input_node: [obs]})
+        if self._prep is not None:
+            obs = self._prep.transform(obs)
+        res = self._sess.run(self.output_node, feed_dict={self.input_node: [obs]})
         action = res[0]
         return action
 
@@ -84,3 +163,17 @@ agent = Agent(
     reward_adapter=reward_adapter,
     action_adapter=action_adapter,
 )
+
+# same policy as above, but the observation adapter produces the flat model
+# input, so acting skips the RLlib preprocessor
+flat_agent = Agent(
+    interface=AgentInterface.from_type(
+        AgentType.StandardWithAbsoluteSteering, max_episode_steps=1000
+    ),
+    policy=ModelPolicy(str(model_path.absolute()), FLAT_OBSERVATION_SPACE,),
+    observation_space=FLAT_OBSERVATION_SPACE,
+    action_space=ACTION_SPACE,
+    observation_adapter=flat_observation_adapter,
+    reward_adapter=reward_adapter,
+    action_adapter=action_adapter,
+)
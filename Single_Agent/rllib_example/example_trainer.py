@@ -1,16 +1,21 @@
 import os
 import random
 import argparse
+from pathlib import Path
 
-import numpy as np
 from ray import tune
 from ray.tune.schedulers import PopulationBasedTraining
 
 import smarts
-from smarts.env.rllib_hiway_env import RLlibHiWayEnv
 from smarts.core.utils import copy_tree
 
+import episode_metrics
+from autotune import autotuned_config
+from subprocess_envs import with_subprocess_envs
+from throughput_metrics import TimedHiWayEnv, throughput_callbacks
 from agent import agent, TrainingModel
+from episode_recorder import postprocess_traj_recorder
+from offline_reader import offline_input
 
 
 # Path to the scenario to test
@@ -19,38 +24,6 @@ scenario_path = os.path.join(
 )
 
 
-def on_episode_start(info):
-    episode = info["episode"]
-    print("episode {} started".format(episode.episode_id))
-    episode.user_data["ego_speed"] = []
-
-
-def on_episode_step(info):
-    episode = info["episode"]
-    single_agent_id = list(episode._agent_to_last_obs)[0]
-    obs = episode.last_raw_obs_for(single_agent_id)
-    episode.user_data["ego_speed"].append(obs["speed"])
-
-
-def on_episode_end(info):
-    episode = info["episode"]
-    mean_ego_speed = np.mean(episode.user_data["ego_speed"])
-
-    episode.custom_metrics["mean_ego_speed"] = mean_ego_speed
-
-    agent_scores = []
-    for info in episode._agent_to_last_info.values():
-        agent_scores.append(info["score"])
-    mean_dis = np.mean(agent_scores)
-    episode.custom_metrics["distance_travelled"] = mean_dis
-
-    print(
-        "episode {} ended with length {}, distance {}, and mean ego speed {:.2f}".format(
-            episode.episode_id, episode.length, mean_dis, mean_ego_speed
-        )
-    )
-
-
 def main(args):
     # XXX: There is a bug in Ray where we can only export a trained model if
     #      the policy it's attached to is named 'default_policy'.
@@ -64,11 +37,23 @@ def main(args):
         )
     }
 
+    callbacks = episode_metrics.episode_callbacks()
+    if args.record_dir:
+        # record what the policy saw and did, see episode_recorder.read_episode
+        callbacks["on_postprocess_traj"] = postprocess_traj_recorder(
+            os.path.abspath(args.record_dir)
+        )
+
+    # env steps/s, sampler and learner time and simulator step latency,
+    # logged next to the reward every iteration
+    callbacks = throughput_callbacks(callbacks)
+
     smarts.core.seed(args.seed)
     tune_config = {
-        "env": RLlibHiWayEnv,
+        "env": TimedHiWayEnv,
         "log_level": "WARN",
         "num_workers": args.num_workers,
+        "num_envs_per_worker": args.num_envs_per_worker,
         "env_config": {
             "seed": tune.sample_from(lambda spec: random.randint(0, 300)),
             "scenarios": [scenario_path],
@@ -76,20 +61,49 @@ def main(args):
             "agents": {f"AGENT-{i}": agent for i in range(args.num_agents)},
         },
         "multiagent": {"policies": rllib_policies},
-        "callbacks": {
-            "on_episode_start": on_episode_start,
-            "on_episode_step": on_episode_step,
-            "on_episode_end": on_episode_end,
-        },
+        "callbacks": callbacks,
         "horizon": args.horizon,
         "lr": 1e-4,
-        "num_sgd_iter": 10,
-        "lambda": 0.95,
-        "clip_param": 0.2,
-        "sgd_minibatch_size": 1024,
         "train_batch_size": 10240 * 3,
     }
 
+    if args.offline_data:
+        # learn from episodes recorded with --record_dir instead of sampling
+        # the simulator, MARWIL with "beta": 0.0 is behaviour cloning
+        algorithm = "MARWIL"
+        tune_config.update(
+            {
+                "input": offline_input(
+                    os.path.abspath(args.offline_data), agent.action_space
+                ),
+                "input_evaluation": [],
+                "postprocess_inputs": True,
+            }
+        )
+    else:
+        algorithm = "PPO"
+        tune_config.update(
+            {
+                "num_sgd_iter": 10,
+                "lambda": 0.95,
+                "clip_param": 0.2,
+                "sgd_minibatch_size": 1024,
+            }
+        )
+
+    if args.autotune and not args.offline_data:
+        # workers, envs per worker and fragment length measured on this host
+        tune_config.update(
+            autotuned_config(
+                f"{Path(__file__).resolve()}:{args.num_agents}",
+                tune_config,
+                force=args.autotune_force,
+            )
+        )
+
+    # the extra envs of every worker step concurrently in their own processes
+    tune_config = with_subprocess_envs(tune_config)
+
     experiment_name = "rllib_example"
     log_dir = os.path.expanduser("~/ray_results")
 
@@ -100,7 +114,7 @@ def main(args):
 
     print(f"Checkpointing at {log_dir}")
     analysis = tune.run(
-        "PPO",
+        algorithm,
         name=experiment_name,
         stop={"time_total_s": 6 * 60 * 60},  # 6 hour
         checkpoint_freq=5,
@@ -148,6 +162,13 @@ if __name__ == "__main__":
         "--num_workers", type=int, default=4, help="Number of workers used to sample"
     )
     parser.add_argument("--horizon", type=int, default=1000, help="max episode len")
+    parser.add_argument(
+        "--num_envs_per_worker",
+        type=int,
+        default=1,
+        help="Envs per worker, the extra ones in simulator-only processes, acted "
+        "for with one batched policy call",
+    )
     parser.add_argument(
         "--resume_training",
         default=False,
@@ -163,5 +184,28 @@ if __name__ == "__main__":
     parser.add_argument(
         "--checkpoint_num", type=int, default=None, help="Checkpoint number"
     )
+    parser.add_argument(
+        "--record_dir",
+        type=str,
+        default=None,
+        help="Record the sampled episodes to this directory",
+    )
+    parser.add_argument(
+        "--offline_data",
+        type=str,
+        default=None,
+        help="Train from the episodes recorded to this directory",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Pick the workers, envs per worker and fragment length that sample "
+        "fastest on this host, calibrated on the first run",
+    )
+    parser.add_argument(
+        "--autotune_force",
+        action="store_true",
+        help="Calibrate again even if this host has a stored result",
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,146 @@
+# this file is for training from episodes recorded by episode_recorder.py
+import queue
+import random
+import zlib
+import threading
+
+import gym
+import numpy as np
+from ray.rllib.offline import InputReader
+from ray.rllib.policy.sample_batch import SampleBatch
+
+from episode_recorder import list_episodes, read_episode
+
+
+def _episode_chunks(path, chunk_size, discrete_actions):
+    # the episode files are memory-mapped, only the rows of each chunk are
+    # read, and copied so the batch does not keep the files open
+    episode = read_episode(path)
+    steps = len(episode["obs"])
+    if steps == 0:
+        return
+
+    # eps_id has to be an int, derive a stable one from the path
+    eps_id = zlib.crc32(str(path).encode())
+    obs = episode["obs"]
+    for start in range(0, steps, chunk_size):
+        end = min(start + chunk_size, steps)
+        # the next obs of the last recorded step is unknown, it is only used
+        # to bootstrap the value of unfinished episodes, so repeat the last one
+        next_obs = np.minimum(np.arange(start + 1, end + 1), steps - 1)
+
+        actions = np.array(episode["action"][start:end])
+        if discrete_actions:
+            # discrete actions are recorded as one float per step
+            actions = actions[:, 0].astype(np.int64)
+
+        yield SampleBatch(
+            {
+                SampleBatch.OBS: np.array(obs[start:end]),
+                SampleBatch.NEXT_OBS: obs[next_obs],
+                SampleBatch.ACTIONS: actions,
+                SampleBatch.REWARDS: np.array(episode["reward"][start:end, 0]),
+                SampleBatch.DONES: np.array(episode["done"][start:end, 0], dtype=bool),
+                SampleBatch.EPS_ID: np.full(end - start, eps_id),
+                SampleBatch.AGENT_INDEX: np.zeros(end - start, dtype=np.int64),
+                "t": np.arange(start, end),
+            }
+        )
+
+
+class RecordedEpisodeReader(InputReader):
+    """Streams the episodes under `record_dir` as SampleBatches of at most
+    `chunk_size` consecutive steps of one agent episode, forever.
+
+    Prefetch threads read the memory-mapped episode files in a shuffled order
+    every pass and fill a queue, `next()` returns a random batch of a shuffle
+    buffer refilled from that queue, so consecutive batches are unlikely to
+    come from the same episode. An error of a prefetch thread is raised by
+    `next()`. Episodes without steps when the reader is created are skipped.
+    """
+
+    def __init__(
+        self,
+        record_dir,
+        action_space,
+        chunk_size=200,
+        shuffle_buffer_size=64,
+        num_prefetch_threads=2,
+        prefetch_size=128,
+        ioctx=None,
+    ):
+        # empty episodes have no batches, with only those the prefetch
+        # threads would never fill the queue
+        self._paths = [
+            path
+            for path in list_episodes(record_dir)
+            if len(read_episode(path)["obs"])
+        ]
+        if not self._paths:
+            raise ValueError(f"No recorded episodes with steps found in {record_dir}")
+
+        # every rollout worker reads the episodes in its own order
+        worker_index = ioctx.worker_index if ioctx else 0
+        self._rng = random.Random(worker_index)
+        self._order_rng = random.Random(worker_index)
+        self._discrete_actions = isinstance(action_space, gym.spaces.Discrete)
+        self._chunk_size = chunk_size
+        self._shuffle_buffer_size = shuffle_buffer_size
+        self._shuffle_buffer = []
+
+        self._lock = threading.Lock()
+        self._error = None
+        self._order = []
+        self._queue = queue.Queue(maxsize=prefetch_size)
+        for _ in range(num_prefetch_threads):
+            threading.Thread(target=self._prefetch, daemon=True).start()
+
+    def next(self):
+        while len(self._shuffle_buffer) < self._shuffle_buffer_size:
+            if self._error is not None:
+                raise self._error
+
+            batch = self._queue.get()
+            if isinstance(batch, Exception):
+                # the thread that put it has stopped, keep failing after this
+                self._error = batch
+            else:
+                self._shuffle_buffer.append(batch)
+
+        i = self._rng.randrange(len(self._shuffle_buffer))
+        # swap with the last batch so the pop is O(1)
+        buffer = self._shuffle_buffer
+        buffer[i], buffer[-1] = buffer[-1], buffer[i]
+        return buffer.pop()
+
+    def _next_path(self):
+        with self._lock:
+            if not self._order:
+                self._order = list(self._paths)
+                self._order_rng.shuffle(self._order)
+            return self._order.pop()
+
+    def _prefetch(self):
+        try:
+            while True:
+                chunks = _episode_chunks(
+                    self._next_path(), self._chunk_size, self._discrete_actions
+                )
+                for batch in chunks:
+                    self._queue.put(batch)
+        except Exception as e:
+            # hand the error to next(), which would otherwise wait forever
+            self._queue.put(e)
+
+
+def offline_input(record_dir, action_space, **reader_kwargs):
+    """Returns an RLlib "input" creator that reads `record_dir` with a
+    RecordedEpisodeReader in every rollout worker.
+    """
+
+    def input_creator(ioctx):
+        return RecordedEpisodeReader(
+            record_dir, action_space, ioctx=ioctx, **reader_kwargs
+        )
+
+    return input_creator
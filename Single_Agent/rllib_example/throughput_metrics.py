@@ -0,0 +1,159 @@
+# this file is for the sampling throughput metrics reported every training iteration
+import time
+import dataclasses
+
+from smarts.env.rllib_hiway_env import RLlibHiWayEnv
+
+from time_histogram import TimeHistogram
+
+
+class TimedHiWayEnv(RLlibHiWayEnv):
+    """RLlibHiWayEnv that times its steps, the simulator (SMARTS and SUMO)
+    part of them and the observation adapters, for `episode_metrics()`.
+    """
+
+    def __init__(self, config):
+        self._env_step = TimeHistogram()
+        self._simulator_step = TimeHistogram()
+        self._observation_adapter_seconds = 0.0
+        super().__init__(config)
+        self._agents = {
+            agent_id: dataclasses.replace(
+                agent, observation_adapter=self._timed(agent.observation_adapter)
+            )
+            for agent_id, agent in self._agents.items()
+        }
+
+    def _timed(self, observation_adapter):
+        def timed_observation_adapter(env_observation):
+            start = time.perf_counter()
+            try:
+                return observation_adapter(env_observation)
+            finally:
+                self._observation_adapter_seconds += time.perf_counter() - start
+
+        return timed_observation_adapter
+
+    def _timed_simulator_step(self, simulator_step):
+        def timed_step(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return simulator_step(*args, **kwargs)
+            finally:
+                self._simulator_step.add(time.perf_counter() - start)
+
+        return timed_step
+
+    def reset(self):
+        built = self._smarts is not None
+        observations = super().reset()
+        if not built:
+            self._smarts.step = self._timed_simulator_step(self._smarts.step)
+        return observations
+
+    def step(self, agent_actions):
+        start = time.perf_counter()
+        try:
+            return super().step(agent_actions)
+        finally:
+            self._env_step.add(time.perf_counter() - start)
+
+    def episode_metrics(self):
+        """Step times since the last call, in milliseconds."""
+        steps = self._env_step.count
+        if not steps:
+            return {}
+        # the adapter time includes the first observations after reset
+        adapter_seconds = self._observation_adapter_seconds
+        metrics = {
+            "env_step_mean_ms": 1000 * self._env_step.total / steps,
+            "observation_adapter_ms_per_step": 1000 * adapter_seconds / steps,
+        }
+        for p in (50, 90, 99):
+            latency = self._simulator_step.percentile(p / 100)
+            metrics[f"simulator_step_p{p}_ms"] = 1000 * latency
+
+        self._env_step = TimeHistogram()
+        self._simulator_step = TimeHistogram()
+        self._observation_adapter_seconds = 0.0
+        return metrics
+
+
+def on_episode_end(info):
+    episode = info["episode"]
+    base_env = info["env"]
+    if hasattr(base_env, "pop_episode_metrics"):
+        # SubprocessHiWayEnv, whose envs in other processes are not unwrapped
+        episode.custom_metrics.update(base_env.pop_episode_metrics())
+        return
+
+    for env in base_env.get_unwrapped():
+        if isinstance(env, TimedHiWayEnv):
+            episode.custom_metrics.update(env.episode_metrics())
+
+
+def on_train_result(info):
+    """Adds `throughput` to the result of the iteration, logged with the
+    reward: env steps/s overall, per worker and per simulator, the share of
+    the iteration spent sampling and learning, simulator step percentiles
+    and the share of sampling spent in the observation adapters.
+    """
+    result = info["result"]
+    config = info["trainer"].config
+    num_workers = max(config["num_workers"], 1)
+    # SubprocessHiWayEnv keeps its envs in env_config
+    num_simulators = (
+        num_workers
+        * config["num_envs_per_worker"]
+        * config["env_config"].get("num_envs", 1)
+    )
+    custom_metrics = result.get("custom_metrics", {})
+    throughput = {}
+
+    sample_ms = result.get("info", {}).get("sample_time_ms")
+    if sample_ms:
+        steps_per_s = result["timesteps_this_iter"] / (sample_ms / 1000)
+        throughput["env_steps_per_s"] = steps_per_s
+        throughput["env_steps_per_s_per_worker"] = steps_per_s / num_workers
+        throughput["env_steps_per_s_per_simulator"] = steps_per_s / num_simulators
+        sampler_share = min(sample_ms / (1000 * result["time_this_iter_s"]), 1.0)
+        throughput["sampler_time_share"] = sampler_share
+        throughput["learner_time_share"] = 1.0 - sampler_share
+
+    # time per env poll of the sampler: env step, obs processing, inference
+    # and action processing
+    sampler_ms_per_step = sum(result.get("sampler_perf", {}).values())
+    adapter_ms = custom_metrics.get("observation_adapter_ms_per_step_mean")
+    if sampler_ms_per_step and adapter_ms is not None:
+        throughput["observation_adapter_share"] = adapter_ms / sampler_ms_per_step
+
+    for p in (50, 90, 99):
+        latency = custom_metrics.get(f"simulator_step_p{p}_ms_mean")
+        if latency is not None:
+            throughput[f"simulator_step_p{p}_ms"] = latency
+
+    result["throughput"] = throughput
+
+
+def throughput_callbacks(callbacks):
+    """RLlib `callbacks` that also report the metrics above, for trainers
+    sampling from TimedHiWayEnv.
+    """
+    on_episode_end_ = callbacks.get("on_episode_end")
+    on_train_result_ = callbacks.get("on_train_result")
+
+    def timed_on_episode_end(info):
+        if on_episode_end_ is not None:
+            on_episode_end_(info)
+        on_episode_end(info)
+
+    def timed_on_train_result(info):
+        if on_train_result_ is not None:
+            on_train_result_(info)
+        on_train_result(info)
+
+    return dict(
+        callbacks,
+        on_episode_end=timed_on_episode_end,
+        on_train_result=timed_on_train_result,
+    )
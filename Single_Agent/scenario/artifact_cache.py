@@ -0,0 +1,77 @@
+# this file is for caching generated scenario files under the hash of their inputs
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("SCENARIO_ARTIFACT_CACHE_DIR", "~/.cache/scenario_artifacts")
+).expanduser()
+
+DEFAULT_MAX_BYTES = int(os.environ.get("SCENARIO_ARTIFACT_CACHE_MB", 1024)) << 20
+
+
+def _copy(src, dst):
+    # copy to a temporary file and rename it, so readers never see a partial
+    # file and concurrent writers of the same entry do not interfere
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dst.parent, prefix=".tmp-")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ArtifactCache:
+    """Generated files stored flat in `cache_dir` under a digest of
+    everything they depend on (see `scenario_build.task_digest`).
+
+    Entries are touched when they are read, and the least recently used
+    ones are deleted once the cache holds more than `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def get(self, digest, output):
+        """Copies the entry of `digest` to `output`, returns False on a miss."""
+        path = self.cache_dir / digest
+        try:
+            _copy(path, output)
+            os.utime(path)
+        except FileNotFoundError:
+            # missing, or evicted by another build in the meantime
+            return False
+        return True
+
+    def put(self, digest, output):
+        """Stores the generated file `output` as the entry of `digest`."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        _copy(output, self.cache_dir / digest)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.cache_dir.iterdir():
+            if path.name.startswith(".tmp-"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
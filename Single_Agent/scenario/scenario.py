@@ -1,8 +1,8 @@
 import os
 import random
+import argparse
 
 from smarts.core import seed
-from smarts.sstudio import gen_traffic, gen_missions
 from smarts.sstudio.types import (
     Traffic,
     Flow,
@@ -15,6 +15,9 @@ from smarts.sstudio.types import (
     JunctionModel,
 )
 
+from artifact_cache import ArtifactCache, DEFAULT_CACHE_DIR
+from scenario_build import build, traffic_task
+
 seed_ = 3
 seed(seed_)
 
@@ -40,11 +43,36 @@ traffic = Traffic(
     ]
 )
 
-gen_traffic(
-    scenario_path,
-    traffic,
-    name="all",
-    output_dir=scenario_path,
-    seed=seed_,
-    overwrite=True,
-)
+
+def main(args):
+    cache = None if args.no_cache else ArtifactCache(args.cache_dir)
+    # skipped if the map, flows and seed did not change since the last run
+    tasks = [
+        traffic_task(
+            scenario_path, traffic, name="all", output_dir=scenario_path, seed=seed_,
+        )
+    ]
+    build(tasks, jobs=args.jobs, force=args.force, cache=cache)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("scenario")
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Processes, one per core by default"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Generate every artifact, even the up to date ones",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help="Cache of generated artifacts shared by all builds on this machine",
+    )
+    parser.add_argument(
+        "--no_cache", action="store_true", help="Do not use the artifact cache"
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,188 @@
+# this file is for generating scenario artifacts in parallel, skipping the
+# ones whose inputs did not change since they were generated
+import json
+import hashlib
+import dataclasses
+import multiprocessing
+from pathlib import Path
+from collections import namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from smarts.sstudio import gen_traffic, gen_missions, gen_social_agent_missions
+from smarts.sstudio.types import RandomRoute
+
+STAMP_FILE = ".build_stamps.json"
+
+# where the output goes, not what it contains, so left out of the digest
+_LOCATION_KWARGS = ("scenario", "output_dir")
+
+# one generated file, `generate(**kwargs)` writes `output`
+BuildTask = namedtuple("BuildTask", ["scenario", "output", "generate", "kwargs"])
+
+
+def traffic_task(scenario, traffic, name, seed=42, output_dir=None):
+    scenario = Path(scenario)
+    output_dir = Path(output_dir or scenario)
+    return BuildTask(
+        scenario=scenario,
+        output=output_dir / "traffic" / f"{name}.rou.xml",
+        generate=gen_traffic,
+        kwargs=dict(
+            scenario=str(scenario),
+            traffic=traffic,
+            name=name,
+            output_dir=str(output_dir),
+            seed=seed,
+            overwrite=True,
+        ),
+    )
+
+
+def missions_task(scenario, missions, seed=42):
+    scenario = Path(scenario)
+    return BuildTask(
+        scenario=scenario,
+        output=scenario / "missions.pkl",
+        generate=gen_missions,
+        kwargs=dict(
+            scenario=str(scenario), missions=missions, seed=seed, overwrite=True
+        ),
+    )
+
+
+def social_agent_missions_task(scenario, missions, social_agent_actor, name, seed=42):
+    scenario = Path(scenario)
+    return BuildTask(
+        scenario=scenario,
+        output=scenario / "social_agents" / f"{name}.pkl",
+        generate=gen_social_agent_missions,
+        kwargs=dict(
+            scenario=str(scenario),
+            missions=missions,
+            social_agent_actor=social_agent_actor,
+            name=name,
+            seed=seed,
+            overwrite=True,
+        ),
+    )
+
+
+def _canonical(value, random_routes):
+    """`value` as nested tuples whose repr is the same in every run. The
+    repr of sstudio types is not: a RandomRoute gets a random uuid as id,
+    and LaneChangingModel and JunctionModel show their address.
+    """
+    if isinstance(value, RandomRoute):
+        # only which flows share a route matters, numbered by first use
+        return ("RandomRoute", random_routes.setdefault(value.id, len(random_routes)))
+    if dataclasses.is_dataclass(value):
+        return (type(value).__name__,) + tuple(
+            (field.name, _canonical(getattr(value, field.name), random_routes))
+            for field in dataclasses.fields(value)
+        )
+    if isinstance(value, Mapping):
+        return (type(value).__name__,) + tuple(
+            (_canonical(k, random_routes), _canonical(v, random_routes))
+            for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(item, random_routes) for item in value)
+    return value
+
+
+def task_digest(task):
+    """Hash of everything the output of `task` depends on: the map, the
+    generator and its arguments, like the flows, missions and seed. It does
+    not depend on where the scenario is, so checkouts share cache entries.
+    """
+    digest = hashlib.sha1()
+    with open(task.scenario / "map.net.xml", "rb") as f:
+        digest.update(f.read())
+    digest.update(task.generate.__name__.encode())
+    kwargs = {k: v for k, v in task.kwargs.items() if k not in _LOCATION_KWARGS}
+    digest.update(repr(_canonical(sorted(kwargs.items()), {})).encode())
+    return digest.hexdigest()
+
+
+def _load_stamps(scenario):
+    path = scenario / STAMP_FILE
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_stamps(scenario, stamps):
+    path = scenario / STAMP_FILE
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(stamps, f, indent=2, sort_keys=True)
+    tmp_path.replace(path)
+
+
+def _run(task):
+    task.generate(**task.kwargs)
+
+
+def _stamp(stamps, task, key, digest):
+    # stamped as soon as it is done, an interrupted build keeps them
+    stamps[task.scenario][key] = digest
+    _save_stamps(task.scenario, stamps[task.scenario])
+
+
+def build(tasks, jobs=None, force=False, cache=None):
+    """Runs the tasks whose output is missing or whose inputs changed since
+    the last build on a pool of `jobs` processes (one per core by default),
+    or all of them with `force`.
+
+    With an ArtifactCache, outputs generated before from the same inputs,
+    by any build on this machine, are copied from the cache instead, and
+    new outputs are added to it.
+    """
+    stamps = {}
+    todo = []
+    num_cached = 0
+    for task in tasks:
+        if task.scenario not in stamps:
+            stamps[task.scenario] = _load_stamps(task.scenario)
+        key = str(task.output.relative_to(task.scenario))
+        digest = task_digest(task)
+        up_to_date = task.output.exists() and stamps[task.scenario].get(key) == digest
+        if force:
+            todo.append((task, key, digest))
+        elif up_to_date:
+            continue
+        elif cache is not None and cache.get(digest, task.output):
+            _stamp(stamps, task, key, digest)
+            num_cached += 1
+            print(f"copied {task.output} from the cache")
+        else:
+            todo.append((task, key, digest))
+
+    num_up_to_date = len(tasks) - len(todo) - num_cached
+    print(
+        f"{num_up_to_date} of {len(tasks)} artifacts are up to date, "
+        f"{num_cached} copied from the cache"
+    )
+    if not todo:
+        return
+
+    jobs = min(jobs or multiprocessing.cpu_count(), len(todo))
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_run, item[0]): item for item in todo}
+        for future in as_completed(futures):
+            task, key, digest = futures[future]
+            if future.exception() is not None:
+                print(f"failed to generate {task.output}: {future.exception()!r}")
+                failed.append(task)
+                continue
+
+            _stamp(stamps, task, key, digest)
+            if cache is not None:
+                cache.put(digest, task.output)
+            print(f"generated {task.output}")
+
+    if failed:
+        raise RuntimeError(f"failed to generate {len(failed)} artifacts")